@@ -0,0 +1,347 @@
+"""Benchmarks for spyql's hot paths.
+
+`python bench_spyql.py` runs the workload suite and prints throughput, latency percentiles and
+peak memory for each workload.  Save a baseline with `--save-baseline bench_baseline.json` and
+later runs given `--baseline bench_baseline.json` exit with status 1 when a workload's median
+latency is more than `--threshold` (default 25%) slower.  A baseline records whether it was a
+`--quick` run and which interpreter recorded it; runs that differ in either exit with status 2
+without comparing.  `--extended` also runs the scaling, combine, parse_many and memory benchmarks.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import random
+import sys
+import timeit
+
+from spyql import SQL, SQLSelect, SQLWhere, parse_many, tokenize_sql_component
+
+KB = 1024
+MB = 1024 * KB
+
+def make_statement(size):
+    """Builds a generated query of roughly `size` characters with a long CASE expression and a big IN list."""
+    case = ' '.join('when c%d > %d then %d' % (i, i, i) for i in range(size // 60 + 1))
+    values = []
+    length = len(case)
+    i = 0
+    while length < size:
+        value = "'v%d'" % i
+        values.append(value)
+        length += len(value) + 2
+        i += 1
+    return 'SELECT a, case %s else 0 end AS b FROM t WHERE x IN (%s) GROUP BY a ORDER BY b LIMIT 10' % (case, ', '.join(values))
+
+def time_call(function, argument, repeat=3):
+    return min(timeit.repeat(lambda: function(argument), number=1, repeat=repeat))
+
+def bench_tokenize_scaling(sizes=(KB, 10 * KB, 100 * KB, MB, 10 * MB)):
+    print('tokenize_sql_component scaling')
+    print('%12s %12s %12s' % ('bytes', 'seconds', 'us/KB'))
+    for size in sizes:
+        statement = make_statement(size)
+        seconds = time_call(tokenize_sql_component, statement)
+        print('%12d %12.6f %12.3f' % (len(statement), seconds, seconds * 1e6 / (len(statement) / float(KB))))
+
+def bench_from_string_scaling(sizes=(KB, 10 * KB, 100 * KB, MB, 10 * MB)):
+    print('SQL.from_string scaling')
+    print('%12s %12s %12s' % ('bytes', 'seconds', 'us/KB'))
+    for size in sizes:
+        statement = make_statement(size)
+        seconds = time_call(SQL.from_string, statement)
+        print('%12d %12.6f %12.3f' % (len(statement), seconds, seconds * 1e6 / (len(statement) / float(KB))))
+
+def bench_combine(count=10000):
+    queries = []
+    for i in range(count):
+        queries.append(SQL.from_string('SELECT c%d FROM t%d' % (i, i)))
+        queries.append(SQLWhere('c%d > %d' % (i, i)))
+
+    def loop():
+        sql = queries[0].copy()
+        for query in queries[1:]:
+            sql += query
+        return sql
+
+    def combine():
+        return SQL.combine(queries)
+
+    assert loop().as_string == combine().as_string
+    print('combining %d inputs' % len(queries))
+    print('%12s %12.6f' % ('+= loop', min(timeit.repeat(loop, number=1, repeat=3))))
+    print('%12s %12.6f' % ('combine', min(timeit.repeat(combine, number=1, repeat=3))))
+
+def make_corpus(count):
+    return ['SELECT a%d, b FROM t%d t INNER JOIN u USING (id) WHERE t.a > %d and u.b IN (1, 2, 3) ORDER BY b LIMIT 10' % (i, i % 64, i)
+            for i in range(count)]
+
+def bench_parse_many(count=1000000, chunksize=2048):
+    corpus = make_corpus(count)
+    print('parse_many over %d statements' % count)
+    print('%12s %12s %12s' % ('workers', 'seconds', 'speedup'))
+    baseline = None
+    workers = 1
+    while workers <= multiprocessing.cpu_count():
+        seconds = min(timeit.repeat(lambda: parse_many(corpus, workers=workers, chunksize=chunksize), number=1, repeat=1))
+        baseline = baseline or seconds
+        print('%12d %12.3f %12.2f' % (workers, seconds, baseline / seconds))
+        workers *= 2
+
+def deep_sizeof(obj, seen=None):
+    """Approximates the bytes held by obj and everything it references, for interpreters without tracemalloc."""
+    seen = set() if seen is None else seen
+    if id(obj) in seen or isinstance(obj, type):
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, (tuple, list)):
+        size += sum(deep_sizeof(item, seen) for item in obj)
+    elif isinstance(obj, dict):
+        size += sum(deep_sizeof(key, seen) + deep_sizeof(value, seen) for key, value in obj.items())
+    else:
+        if hasattr(obj, '__dict__'):
+            size += deep_sizeof(obj.__dict__, seen)
+        for cls in type(obj).__mro__:
+            for slot in cls.__dict__.get('__slots__', ()):
+                if hasattr(obj, slot):
+                    size += deep_sizeof(getattr(obj, slot), seen)
+    return size
+
+def measure_bytes_per_object(build, count):
+    try:
+        import tracemalloc
+    except ImportError:
+        objects = build(count)
+        return 'getsizeof', (deep_sizeof(objects) - sys.getsizeof(objects)) / float(count)
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    objects = build(count)
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    allocated = sum(stat.size_diff for stat in after.compare_to(before, 'filename'))
+    return 'tracemalloc', allocated / float(count)
+
+def bench_memory(count=100000):
+    corpus = make_corpus(1000)
+    statements = [corpus[i % len(corpus)] for i in range(count)]
+    print('memory per parsed query (%d queries, source statement text excluded)' % count)
+
+    def build_sql(count):
+        return [SQL.from_string(statement) for statement in statements[:count]]
+
+    def build_components(count):
+        return [SQLWhere(statement) for statement in statements[:count]]
+
+    def build_strings(count):
+        return [statement for statement in statements[:count]]
+
+    method, string_bytes = measure_bytes_per_object(build_strings, count)
+    for name, build in (('SQL', build_sql), ('SQLWhere', build_components)):
+        method, object_bytes = measure_bytes_per_object(build, count)
+        print('%12s %12.1f bytes (%s)' % (name, object_bytes - string_bytes, method))
+
+def make_oltp_statements(count, seed=0):
+    rng = random.Random(seed)
+    templates = [
+        'SELECT id, name, email FROM users WHERE id = %d',
+        'SELECT o.id, o.total FROM orders o INNER JOIN users u USING (user_id) WHERE u.id = %d ORDER BY o.created_at DESC LIMIT 20',
+        "SELECT count(*) FROM sessions WHERE user_id = %d and expires_at > '2018-01-01' GROUP BY user_id",
+        'SELECT sku, sum(quantity) FROM order_items WHERE order_id = %d GROUP BY sku HAVING sum(quantity) > 1 ORDER BY sku',
+    ]
+    return [rng.choice(templates) % rng.randint(1, 10 ** 6) for _ in range(count)]
+
+def make_nested_statement(depth):
+    statement = 'SELECT k FROM base WHERE k > 0'
+    for level in range(depth):
+        statement = 'SELECT k%d, (select max(v) from side%d where side%d.k = t%d.k) FROM (%s) t%d WHERE k%d IS NOT NULL ORDER BY k%d' % (
+            level, level, level, level, statement, level, level, level)
+    return statement
+
+def make_in_list_statement(size, seed=0):
+    rng = random.Random(seed)
+    values = ', '.join(str(rng.randint(1, 10 ** 9)) for _ in range(size))
+    return 'SELECT id, payload FROM events WHERE id IN (%s) and kind = \'click\' ORDER BY id LIMIT 1000' % values
+
+def add_chain(length):
+    sql = SQL.from_string('SELECT c0 FROM t')
+    for i in range(1, length):
+        sql += SQLSelect('c%d' % i)
+        sql += SQLWhere('c%d > %d' % (i, i))
+    return sql.as_string
+
+def get_workloads(quick=False):
+    """Returns (name, operation, inputs) triples; each operation is timed once per input."""
+    scale = 10 if quick else 1
+    oltp = make_oltp_statements(20000 // scale)
+    oltp_parsed = [SQL.from_string(statement) for statement in oltp]
+    nested = [make_nested_statement(50)] * (200 // scale)
+    in_list = [make_in_list_statement(50000)] * (20 // scale or 1)
+    in_list_parsed = [SQL.from_string(statement) for statement in in_list]
+    fragments = [SQL.from_string('SELECT c%d FROM t%d WHERE c%d > %d' % (i, i, i, i)) for i in range(1000)]
+    return [
+        ('oltp_parse', SQL.from_string, oltp),
+        ('oltp_render', lambda sql: sql.as_string, oltp_parsed),
+        ('nested_parse', SQL.from_string, nested),
+        ('in_list_parse', SQL.from_string, in_list),
+        ('in_list_render', lambda sql: sql.as_string, in_list_parsed),
+        ('add_chain', add_chain, [1000] * (50 // scale)),
+        ('combine', SQL.combine, [fragments] * (50 // scale)),
+    ]
+
+def percentile(sorted_values, fraction):
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+def measure_peak_memory(operation, inputs):
+    """Peak bytes allocated while running operation over a few inputs.
+
+    Without tracemalloc (Python 2) the inputs run in a forked child, which reports how far its peak RSS grew
+    past the RSS it started with, so one workload's allocations don't show up in the next one's figure.
+    Returns (None, None) where neither is available.
+    """
+    try:
+        import tracemalloc
+    except ImportError:
+        return measure_forked_rss(operation, inputs)
+    tracemalloc.start()
+    for argument in inputs[:10]:
+        operation(argument)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak, 'tracemalloc'
+
+def measure_forked_rss(operation, inputs):
+    try:
+        import resource
+        fork = os.fork
+    except (ImportError, AttributeError):
+        return None, None
+    read_end, write_end = os.pipe()
+    pid = fork()
+    if pid == 0:
+        status = 1
+        try:
+            os.close(read_end)
+            start = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            for argument in inputs[:10]:
+                operation(argument)
+            growth = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - start
+            os.write(write_end, str(growth * 1024).encode('ascii'))
+            status = 0
+        finally:
+            os._exit(status)
+    os.close(write_end)
+    chunks = []
+    while True:
+        chunk = os.read(read_end, 64)
+        if not chunk:
+            break
+        chunks.append(chunk)
+    os.close(read_end)
+    os.waitpid(pid, 0)
+    if not chunks:
+        return None, None
+    return int(b''.join(chunks)), 'forked rss'
+
+def run_workload(operation, inputs):
+    timer = timeit.default_timer
+    latencies = []
+    started = timer()
+    for argument in inputs:
+        start = timer()
+        operation(argument)
+        latencies.append(timer() - start)
+    elapsed = timer() - started
+    latencies.sort()
+    peak_memory, memory_method = measure_peak_memory(operation, inputs)
+    return {
+        'operations': len(inputs),
+        'ops_per_sec': len(inputs) / elapsed,
+        'p50_ms': percentile(latencies, 0.50) * 1e3,
+        'p90_ms': percentile(latencies, 0.90) * 1e3,
+        'p99_ms': percentile(latencies, 0.99) * 1e3,
+        'peak_memory_kb': None if peak_memory is None else peak_memory / 1024.0,
+        'memory_method': memory_method,
+    }
+
+def run_suite(quick=False, only=None):
+    results = {}
+    print('%-16s %10s %12s %10s %10s %10s %14s' % ('workload', 'ops', 'ops/sec', 'p50 ms', 'p90 ms', 'p99 ms', 'peak mem KB'))
+    for name, operation, inputs in get_workloads(quick):
+        if only and name not in only:
+            continue
+        result = results[name] = run_workload(operation, inputs)
+        peak_memory = '-' if result['peak_memory_kb'] is None else '%.1f' % result['peak_memory_kb']
+        print('%-16s %10d %12.1f %10.3f %10.3f %10.3f %14s' % (
+            name, result['operations'], result['ops_per_sec'], result['p50_ms'], result['p90_ms'], result['p99_ms'], peak_memory))
+    return results
+
+def compare_to_baseline(results, baseline, threshold):
+    """Prints the change in median latency per workload and returns the names of those slower than threshold."""
+    regressions = []
+    print('%-16s %12s %12s %10s' % ('workload', 'baseline ms', 'current ms', 'change'))
+    for name, result in sorted(results.items()):
+        if name not in baseline:
+            continue
+        before = baseline[name]['p50_ms']
+        change = result['p50_ms'] / before - 1 if before else 0.0
+        regressed = change > threshold
+        if regressed:
+            regressions.append(name)
+        print('%-16s %12.3f %12.3f %+9.1f%%%s' % (name, before, result['p50_ms'], change * 100, ' REGRESSION' if regressed else ''))
+    return regressions
+
+def get_interpreter():
+    """Names the running interpreter and its major.minor version, e.g. 'CPython 2.7'."""
+    return '%s %d.%d' % (platform.python_implementation(), sys.version_info[0], sys.version_info[1])
+
+def get_baseline_mismatches(baseline, mode):
+    """Returns why results of this run cannot be compared to baseline, if they can't."""
+    mismatches = []
+    if baseline.get('mode') != mode:
+        mismatches.append('the baseline is a %s run, this is a %s run' % (baseline.get('mode', 'unrecorded'), mode))
+    if baseline.get('interpreter') != get_interpreter():
+        mismatches.append('the baseline was recorded on %s, this is %s' % (baseline.get('interpreter', 'an unrecorded interpreter'), get_interpreter()))
+    return mismatches
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmarks for spyql hot paths.')
+    parser.add_argument('--quick', action='store_true', help='run a tenth of the operations per workload')
+    parser.add_argument('--workload', action='append', help='only run this workload (repeatable)')
+    parser.add_argument('--baseline', help='JSON baseline to compare median latencies against')
+    parser.add_argument('--save-baseline', help='write the results to this JSON file')
+    parser.add_argument('--threshold', type=float, default=0.25, help='allowed median latency slowdown, as a fraction')
+    parser.add_argument('--extended', action='store_true', help='also run the scaling, combine, parse_many and memory benchmarks')
+    args = parser.parse_args(argv)
+
+    mode = 'quick' if args.quick else 'full'
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+        mismatches = get_baseline_mismatches(baseline, mode)
+        if mismatches:
+            # Latencies from another mode or interpreter are not comparable; don't report false regressions.
+            print('Cannot compare to %s: %s.' % (args.baseline, '; '.join(mismatches)))
+            return 2
+
+    results = run_suite(args.quick, args.workload)
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as baseline_file:
+            json.dump({'python': sys.version.split()[0], 'interpreter': get_interpreter(), 'mode': mode, 'workloads': results},
+                      baseline_file, indent=2, separators=(',', ': '), sort_keys=True)
+    status = 0
+    if baseline is not None:
+        if compare_to_baseline(results, baseline['workloads'], args.threshold):
+            status = 1
+    if args.extended:
+        bench_tokenize_scaling()
+        bench_from_string_scaling()
+        bench_combine()
+        bench_parse_many()
+        bench_memory()
+    return status
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,9 +1,174 @@
 """A library for handling SQL-like queries with light input validation and basic arithmetic support for combining queries.
 """
+import codecs
+import hashlib
+import itertools
+import mmap
+import multiprocessing
+import numbers
+import os
+import re
+import struct
+import sys
+import tempfile
+import threading
+import time
+import timeit
+from contextlib import contextmanager
+from collections import OrderedDict, namedtuple
+try:
+    import fcntl
+except ImportError:
+    # Not on Windows, where SQLDiskCache cannot lock its directory between processes.
+    fcntl = None
 
 joins = ['inner join', 'left outer join']
+component_names = ['select', 'from', 'where', 'group by', 'having', 'order by', 'limit']
+component_indexes = dict((name, index) for index, name in enumerate(component_names))
+
+# Standard SQL only escapes a quote inside a quoted string by doubling it ('it''s'), so a backslash is
+# an ordinary character there and 'C:\' is a whole literal.  For dialects that escape with a backslash
+# (MySQL), set_backslash_escapes(True) recompiles every pattern below that skips quoted strings.
+backslash_escapes = False
+
+def get_quoted_patterns(escapes):
+    """Returns the patterns of single- and double-quoted strings, with or without backslash escapes."""
+    if escapes:
+        return {'single': r"'(?:[^'\\]|\\.|'')*'?", 'double': r'"(?:[^"\\]|\\.|"")*"?'}
+    return {'single': r"'(?:[^']|'')*'?", 'double': r'"(?:[^"]|"")*"?'}
+
+# Quoted literals are matched whole so that parentheses and keywords inside them are skipped;
+# clause keywords only count when they stand alone as words.
+tokenizer_source = r"""
+    %(single)s
+    |%(double)s
+    |`[^`]*`?
+    |(?P<open>\()
+    |(?P<close>\))
+    |(?<![\w.$])(?P<keyword>select|from|where|group\s+by|having|order\s+by|limit)(?![\w.$])
+"""
+
+# The same patterns for bytes-like sources (bytes, bytearray, mmap); on Python 2 str already is bytes.
+def get_bytes_pattern(pattern):
+    if isinstance(pattern.pattern, bytes):
+        return pattern
+    return re.compile(pattern.pattern.encode('ascii'), pattern.flags & ~re.UNICODE)
+
+clause_whitespace_bytes_pattern = get_bytes_pattern(re.compile(r'[\n\t]'))
+trailing_characters = (' ', '\t', '\n', '\r', ';', b' ', b'\t', b'\n', b'\r', b';')
+
+# What ends the current state of the statement splitter: None is plain text, the others are the
+# token that opened a quoted string or comment.  A '-', '/' or '*' at the very end of a chunk is
+# matched too, because it may be the first half of a token continuing in the next chunk.
+statement_splitter_patterns = {
+    None: re.compile(r"""[;()'"`]|--|/\*|[-/]\Z"""),
+    "'": re.compile(r"'"),
+    '"': re.compile(r'"'),
+    '`': re.compile(r'`'),
+    '--': re.compile(r'\n'),
+    '/*': re.compile(r'\*/|\*\Z'),
+}
+
+# Named placeholders (:name) outside of quoted literals; '::' is skipped so that casts are left alone.
+placeholder_source = r"""%(single)s|%(double)s|::|(?<![\w:]):(?P<name>[A-Za-z_]\w*)"""
+# Values that bind and bind_params expand into a parenthesized list.
+sequence_types = (list, tuple, set, frozenset)
+paramstyle_markers = {
+    'qmark': lambda name, position: '?',
+    'numeric': lambda name, position: ':%d' % position,
+    'named': lambda name, position: ':%s' % name,
+    'format': lambda name, position: '%s',
+    'pyformat': lambda name, position: '%%(%s)s' % name,
+}
+
+# Used by SQL.fingerprint: literals (and parenthesized lists of them) become '?', keywords are upper-cased
+# and whitespace is collapsed.  Quoted identifiers are kept as they are.
+literal_source = r"""%(single)s|(?<![\w.$])(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?(?![\w.$])"""
+fingerprint_source = r"""
+    (?P<list>\(\s*(?:%(literal)s)(?:\s*,\s*(?:%(literal)s))*\s*\))
+    |(?P<literal>%(literal)s)
+    |(?P<quoted>%(double)s|`[^`]*`?)
+    |(?P<space>\s+)
+    |(?P<word>[A-Za-z_][\w$]*)
+"""
+fingerprint_keywords = frozenset("""
+    select from where group by having order limit and or not in is null like between as on join inner left
+    right outer full cross using asc desc case when then else end distinct exists union all any some true false
+""".split())
+Fingerprint = namedtuple('Fingerprint', ['hash', 'text'])
+text_type = type(u'')
+
+# The binary format of to_bytes/from_bytes; see dump_serialized.  Bump serialized_version on any change.
+serialized_magic = b'SPYQ'
+serialized_version = 1
+serialized_header = struct.Struct('>4sBBI')
+serialized_clause = struct.Struct('>BII')
+serialized_absent = 0
+serialized_raw = 1
+serialized_exact = 2
+serialized_integer = 3
+
+# The nodes of an SQLTree.  kind is 'name', 'literal', 'keyword', 'symbol' or 'space' for leaves, which
+# keep their exact text and have no children, or 'group' (a parenthesized expression), 'query' (a
+# parenthesized subquery, whose tree is kept as well) or 'call' (a function name and its group), which
+# only have children.
+Node = namedtuple('Node', ['kind', 'text', 'children'])
+tree_keywords = fingerprint_keywords | frozenset(['natural', 'nulls', 'first', 'last', 'offset'])
+join_keywords = frozenset(['natural', 'inner', 'left', 'right', 'full', 'outer', 'cross', 'join'])
+
+# Used by the optimizing composition of OptimizedSQL.  Quoted literals and parenthesized groups are
+# skipped so that only top-level conjunctions, FROM sources and column references are found.
+quoted_source = r"""%(single)s|%(double)s|`[^`]*`?"""
+conjunction_source = r"""
+    %(quoted)s
+    |(?P<open>\()
+    |(?P<close>\))
+    |(?<![\w.$])(?P<word>and|or|between|case|end)(?![\w.$])
+"""
+source_separator_source = r"""
+    %(quoted)s
+    |(?P<open>\()
+    |(?P<close>\))
+    |(?P<separator>,|(?<![\w.$])(?:natural\s+)?(?:(?:left|right|full)(?:\s+outer)?\s+|inner\s+|cross\s+)?join(?![\w.$]))
+"""
+expression_token_source = r"""
+    (?P<quoted>%(quoted)s)
+    |(?P<number>(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?)
+    |(?P<word>[A-Za-z_][\w$]*(?:\.(?:[A-Za-z_][\w$]*|\*))*)
+    |(?P<space>\s+)
+    |(?P<other>.)
+"""
+
+def set_backslash_escapes(enabled):
+    """Makes a backslash inside quoted strings escape the next character (MySQL) or, by default, not.
+
+    Parse caches are not cleared, so set it before parsing anything.
+    """
+    global backslash_escapes, tokenizer_pattern, tokenizer_bytes_pattern, placeholder_pattern, fingerprint_pattern
+    global conjunction_pattern, source_separator_pattern, expression_token_pattern
+    backslash_escapes = bool(enabled)
+    quoted = get_quoted_patterns(backslash_escapes)
+    quoted['quoted'] = quoted_source % quoted
+    quoted['literal'] = literal_source % quoted
+    tokenizer_pattern = re.compile(tokenizer_source % quoted, re.IGNORECASE | re.VERBOSE | re.DOTALL)
+    tokenizer_bytes_pattern = get_bytes_pattern(tokenizer_pattern)
+    # The splitter skips the character after a backslash itself, so it only has to stop at one.
+    statement_splitter_patterns["'"] = re.compile(r"['\\]" if backslash_escapes else "'")
+    statement_splitter_patterns['"'] = re.compile(r'["\\]' if backslash_escapes else '"')
+    placeholder_pattern = re.compile(placeholder_source % quoted)
+    fingerprint_pattern = re.compile(fingerprint_source % quoted, re.VERBOSE)
+    conjunction_pattern = re.compile(conjunction_source % quoted, re.IGNORECASE | re.VERBOSE)
+    source_separator_pattern = re.compile(source_separator_source % quoted, re.IGNORECASE | re.VERBOSE)
+    expression_token_pattern = re.compile(expression_token_source % quoted, re.VERBOSE | re.DOTALL)
+
+set_backslash_escapes(False)
+
+# Every change to a component or to an SQL object's clauses draws a new, larger version from here.
+versions = itertools.count(1)
 
 class SQLComponent(object):
+    __slots__ = ('_pieces', '_version', '_string')
+
     def __init__(self, value):
         if not value:
             self.value = None
@@ -11,6 +176,29 @@ class SQLComponent(object):
         self.validate_type(value)
         self.value = value
 
+    @property
+    def value(self):
+        # Appended values are kept as a list of pieces (value, join text, value, ...) and only
+        # joined here; the joined string replaces the list until the next append.
+        pieces = self._pieces
+        if pieces.__class__ is list:
+            pieces = self._pieces = ''.join(pieces)
+        return pieces
+
+    @value.setter
+    def value(self, value):
+        self._pieces = value
+        self.changed()
+
+    @property
+    def version(self):
+        return self._version
+
+    def changed(self):
+        """Bumps the version and drops the memoized as_string; call after changing the value in place."""
+        self._version = next(versions)
+        self._string = None
+
     @property
     def expected_type(self):
         raise NotImplementedError('expected_type has not been defined for %s' % self.__class__.__name__)
@@ -22,15 +210,78 @@ class SQLComponent(object):
 
     @property
     def as_string(self):
-        if not self.value.upper().startswith(self.component_name):
-            return '%s %s' % (self.component_name, self.value)
-        value = get_upper_cased_component_value(self.value, self.component_name)
-        return value
+        string = self._string
+        if string is None:
+            string = self.render()
+            object.__setattr__(self, '_string', string)
+        return string
+
+    def render(self):
+        return render_component_value(self.value, self.component_name)
+
+    def has_value(self):
+        """Tells whether value is set, without joining the stored pieces as reading value does."""
+        return bool(self._pieces)
+
+    def iter_render(self):
+        """Yields as_string in fragments: the component name and the stored pieces of the value."""
+        pieces = self._pieces
+        if self._string is not None or pieces.__class__ is not list or is_named_value(pieces[0], self.component_name):
+            yield self.as_string
+            return
+        yield self.component_name + ' '
+        for piece in pieces:
+            yield piece
+
+    def to_bytes(self):
+        """Serializes the component into the compact binary format described at dump_serialized."""
+        return dump_serialized(self.__class__, [get_serialized_clause(self)])
+
+    @classmethod
+    def from_bytes(cls, data):
+        """Loads a component serialized by to_bytes; it keeps the class it was serialized with."""
+        component_class, clauses = load_serialized(data)
+        if not issubclass(component_class, SQLComponent):
+            raise ValueError('Serialized data holds a %s, not an SQLComponent.' % component_class.__name__)
+        return get_deserialized_component(component_class, data, *clauses[0])
+
+    def copy(self):
+        component = self.__class__.__new__(self.__class__)
+        pieces = self._pieces
+        component._pieces = list(pieces) if pieces.__class__ is list else pieces
+        component._version = self._version
+        component._string = self._string
+        return component
+
+    def get_pieces(self):
+        pieces = self._pieces
+        if pieces is None:
+            return None
+        return list(pieces) if pieces.__class__ is list else [pieces]
+
+    def get_pieces_without_component(self):
+        pieces = self.get_pieces()
+        pieces[0] = get_value_without_component_name(pieces[0], self.component_name)
+        return pieces
 
     def get_value_without_component(self):
-        if self.value.upper().startswith(self.component_name):
-            return self.value[len(self.component_name):].strip()
-        return self.value
+        return ''.join(self.get_pieces_without_component())
+
+    def get_join_text(self, other_value_plain):
+        raise NotImplementedError('get_join_text has not been defined for %s' % self.__class__.__name__)
+
+    @classmethod
+    def combine(cls, components):
+        """Merges an iterable of components or raw values in one pass, as if by repeated +."""
+        combined = cls(None)
+        for component in components:
+            if not isinstance(component, SQLComponent):
+                component = cls(component)
+            elif component.component_name != cls.component_name:
+                raise ValueError('Cannot produce %s from %s' % (cls.__name__, type(component).__name__))
+            if component.value:
+                combined._add_instance(component)
+        return combined
 
     def _add_instance(self):
         raise NotImplementedError('_add_rule has not been defined for %s' % self.__class__.__name__)
@@ -41,7 +292,9 @@ class SQLComponent(object):
     def __add__(self, other):
         if hasattr(other, 'value') and not other.value:
             return self
-        if isinstance(other, self.__class__):
+        if self is empty_components.get(self.__class__):
+            self = self.__class__(None)
+        if isinstance(other, SQLComponent) and other.component_name == self.component_name:
             self._add_instance(other)
         elif isinstance(other, self.expected_type):
             self._add_instance(self.__class__(other))
@@ -49,11 +302,16 @@ class SQLComponent(object):
             raise ValueError('Cannot produce %s from %s' % (self.__class__.__name__, type(other).__name__))
         return self
 
+    def __reduce__(self):
+        return (self.__class__, (self.value,))
+
     def __str__(self):
         return self.as_string
 
 class SQLSelect(SQLComponent):
     component_name = 'SELECT'
+    __slots__ = ()
+
     def __init__(self, value):
         super(SQLSelect, self).__init__(value)
 
@@ -61,11 +319,16 @@ class SQLSelect(SQLComponent):
     def expected_type(self):
         return str
 
+    def get_join_text(self, other_value_plain):
+        return ', '
+
     def _add_instance(self, other):
         basic_add_instance(self, other)
 
 class SQLFrom(SQLComponent):
     component_name = 'FROM'
+    __slots__ = ()
+
     def __init__(self, value):
         super(SQLFrom, self).__init__(value)
 
@@ -73,20 +336,20 @@ class SQLFrom(SQLComponent):
     def expected_type(self):
         return str
 
+    def get_join_text(self, other_value_plain):
+        for join in joins:
+            if other_value_plain.lower().strip().startswith(join):
+                return ' '
+        return ', '
+
     def _add_instance(self, other):
-        if not self.value:
-            self.value = other.value
-        else:
-            other_value_plain = other.get_value_without_component()
-            for join in joins:
-                if other_value_plain.lower().strip().startswith(join):
-                    self.value += ' %s' % other_value_plain
-                    return
-            self.value += ', %s' % other_value_plain
+        basic_add_instance(self, other)
 
 
 class SQLWhere(SQLComponent):
     component_name = 'WHERE'
+    __slots__ = ()
+
     def __init__(self, value):
         super(SQLWhere, self).__init__(value)
 
@@ -94,15 +357,16 @@ class SQLWhere(SQLComponent):
     def expected_type(self):
         return str
 
+    def get_join_text(self, other_value_plain):
+        return ' and '
+
     def _add_instance(self, other):
-        if not self.value:
-            self.value = other.value
-        else:
-            other_value_plain = other.get_value_without_component()
-            self.value += ' and %s' % other_value_plain
+        basic_add_instance(self, other)
 
 class SQLGroupBy(SQLComponent):
     component_name = 'GROUP BY'
+    __slots__ = ()
+
     def __init__(self, value):
         super(SQLGroupBy, self).__init__(value)
 
@@ -110,11 +374,16 @@ class SQLGroupBy(SQLComponent):
     def expected_type(self):
         return str
 
+    def get_join_text(self, other_value_plain):
+        return ', '
+
     def _add_instance(self, other):
         basic_add_instance(self, other)
 
 class SQLHaving(SQLComponent):
     component_name = 'HAVING'
+    __slots__ = ()
+
     def __init__(self, value):
         super(SQLHaving, self).__init__(value)
 
@@ -122,15 +391,16 @@ class SQLHaving(SQLComponent):
     def expected_type(self):
         return str
 
+    def get_join_text(self, other_value_plain):
+        return ' and '
+
     def _add_instance(self, other):
-        if not self.value:
-            self.value = other.value
-        else:
-            other_value_plain = other.get_value_without_component()
-            self.value += ' and %s' % other_value_plain
+        basic_add_instance(self, other)
 
 class SQLOrderBy(SQLComponent):
     component_name = 'ORDER BY'
+    __slots__ = ()
+
     def __init__(self, value):
         super(SQLOrderBy, self).__init__(value)
 
@@ -138,11 +408,16 @@ class SQLOrderBy(SQLComponent):
     def expected_type(self):
         return str
 
+    def get_join_text(self, other_value_plain):
+        return ', '
+
     def _add_instance(self, other):
         basic_add_instance(self, other)
 
 class SQLLimit(SQLComponent):
     component_name = 'LIMIT'
+    __slots__ = ()
+
     def __init__(self, value):
         if isinstance(value, str):
             value = value.strip()
@@ -159,30 +434,111 @@ class SQLLimit(SQLComponent):
     def expected_type(self):
         return int
 
-    @property
-    def as_string(self):
+    def render(self):
         return '%s %s' % (self.component_name, self.value)
 
+    def get_pieces_without_component(self):
+        return [self.value]
+
+    def get_value_without_component(self):
+        return self.value
+
+    def get_join_text(self, other_value_plain):
+        raise ValueError('Cannot specify more than 1 LIMIT.')
+
     def _add_instance(self, other):
-        if not self.value:
-            self.value = other.value
-        else:
-            raise ValueError('Cannot specify more than 1 LIMIT.')
+        basic_add_instance(self, other)
+
+def component_property(index):
+    def get_component(self):
+        component = self._components[index]
+        if component is None:
+            component_class = self.component_classes[index][1]
+            if issubclass(component_class, FrozenSQLComponent):
+                # Frozen components cannot change, so every query shares the same empty one.
+                return empty_components[component_class]
+            # Mutable components can be changed in place (sql._where.value = ...), so each query gets
+            # its own empty component on first access instead of one shared between queries.
+            component = component_class(None)
+            object.__setattr__(component, '_version', 0)
+            components = self._components
+            object.__setattr__(self, '_components', components[:index] + (component,) + components[index + 1:])
+            return component
+        if component.__class__ is tuple:
+            # A lazily parsed clause: build the component from its offsets on first access.
+            component = materialize_component(self.component_classes[index][1], self._source, component)
+            # Materializing does not change the query, so the component keeps the version of its offsets.
+            object.__setattr__(component, '_version', 0)
+            components = self._components
+            object.__setattr__(self, '_components', components[:index] + (component,) + components[index + 1:])
+        return component
+
+    def set_component(self, component):
+        if component is empty_components.get(component.__class__):
+            component = None
+        components = self._components
+        self._components = components[:index] + (component,) + components[index + 1:]
+        self._version = next(versions)
+    return property(get_component, set_component)
 
 class SQL(object):
+    component_classes = (
+        ('_select', SQLSelect),
+        ('_from', SQLFrom),
+        ('_where', SQLWhere),
+        ('_group_by', SQLGroupBy),
+        ('_having', SQLHaving),
+        ('_order_by', SQLOrderBy),
+        ('_limit', SQLLimit),
+    )
+    # Opt-in: assign an SQLParseCache to reuse the parse of repeated statements in from_string.
+    parse_cache = None
+    # One component per entry of component_classes: None for an absent clause, or, until the clause
+    # is first accessed, the (start, end) offsets of a lazily parsed clause in _source.
+    # _rendered, _fingerprint and _tree memoize as_string, fingerprint() and tree() as (version, result) pairs.
+    __slots__ = ('_components', '_source', '_version', '_rendered', '_fingerprint', '_tree')
+    _select = component_property(0)
+    _from = component_property(1)
+    _where = component_property(2)
+    _group_by = component_property(3)
+    _having = component_property(4)
+    _order_by = component_property(5)
+    _limit = component_property(6)
+
     def __init__(self, _select=None, _from=None, _where=None, _group_by=None, _having=None, _order_by=None, _limit=None):
-        if not _select and not _from:
+        components = []
+        values = (_select, _from, _where, _group_by, _having, _order_by, _limit)
+        for (_, component_class), value in zip(self.component_classes, values):
+            if isinstance(value, SQLComponent) and not isinstance(value, component_class):
+                value = value.value
+            if not isinstance(value, component_class):
+                value = component_class(value) if value else None
+            components.append(value)
+        object.__setattr__(self, '_components', tuple(components))
+        if not self.get_component(0).value and not self.get_component(1).value:
             raise ValueError('Cannot instantiate SQL object without SELECT or FROM.')
-        self._select = _select and isinstance(_select, SQLSelect) or SQLSelect(_select)
-        self._from = _from and isinstance(_from, SQLFrom) or SQLFrom(_from)
-        self._where = _where and isinstance(_where, SQLWhere) or SQLWhere(_where)
-        self._group_by = _group_by and isinstance(_group_by, SQLGroupBy) or SQLGroupBy(_group_by)
-        self._having = _having and isinstance(_having, SQLHaving) or SQLHaving(_having)
-        self._order_by = _order_by and isinstance(_order_by, SQLOrderBy) or SQLOrderBy(_order_by)
-        self._limit = _limit and isinstance(_limit, SQLLimit) or SQLLimit(_limit)
 
     @classmethod
-    def from_string(cls, sql_string):
+    def from_string(cls, sql_string, lazy=False):
+        """Parses sql_string into an SQL object.
+
+        With lazy set only the clause boundaries are found up front; each clause becomes an SQLComponent
+        the first time it is accessed, and clauses that never are render straight from sql_string.
+        """
+        cache = cls.parse_cache
+        if cache is None:
+            return cls.parse(sql_string, lazy)
+        key = (cls, sql_string, lazy)
+        sql = cache.get(key)
+        if sql is None:
+            sql = cls.parse(sql_string, lazy)
+            cache.put(key, sql.copy(), len(sql_string))
+        return sql
+
+    @classmethod
+    def parse(cls, sql_string, lazy=False):
+        if lazy:
+            return cls.parse_lazily(sql_string)
         SELECT = 0
         FROM = 1
         WHERE = 2
@@ -203,96 +559,1769 @@ class SQL(object):
 
         return cls(_select, _from, _where, _group_by, _having, _order_by, _limit)
 
+    @classmethod
+    def parse_lazily(cls, sql_string):
+        components = [offsets if offsets and offsets[0] != offsets[1] else None for offsets in tokenize_sql_offsets(sql_string)]
+        if not components[0] and not components[1]:
+            raise ValueError('Cannot instantiate SQL object without SELECT or FROM.')
+        limit = components[-1]
+        if limit is not None:
+            components[-1] = cls.component_classes[-1][1](int(get_offsets_value(sql_string, limit)))
+        sql = cls.__new__(cls)
+        object.__setattr__(sql, '_source', sql_string)
+        object.__setattr__(sql, '_components', tuple(components))
+        return sql
+
+    @classmethod
+    def from_buffer(cls, buffer):
+        """Parses a UTF-8 encoded bytes-like buffer (bytes, bytearray or mmap) without copying it.
+
+        Like from_string with lazy set, only clause offsets are recorded; a clause is decoded into a
+        string the first time it is accessed, and write_to writes untouched clauses straight from the
+        buffer.  The buffer must not change while the query uses it.
+        """
+        return cls.parse_lazily(buffer)
+
+    @classmethod
+    def from_file(cls, path):
+        """Parses the statement in the file at path through a read-only mmap of it (see from_buffer)."""
+        with open(path, 'rb') as fileobj:
+            return cls.from_buffer(mmap.mmap(fileobj.fileno(), 0, access=mmap.ACCESS_READ))
+
+    @classmethod
+    def combine(cls, queries):
+        """Merges an iterable of SQL objects, SQLComponents and query strings in one pass.
+
+        The result is the same as adding every item to the first one with +, but none of the items is mutated.
+        """
+        components = [component_class(None) for _, component_class in cls.component_classes]
+        for query in queries:
+            if isinstance(query, str):
+                query = SQL.from_string(query)
+            if isinstance(query, SQL):
+                for index, component in enumerate(components):
+                    other = query.get_component(index)
+                    if other.value:
+                        component._add_instance(other)
+            elif isinstance(query, SQLComponent):
+                if query.value:
+                    components[component_indexes[query.component_name.lower()]]._add_instance(query)
+            else:
+                raise ValueError('Cannot produce %s from %s' % (cls.__name__, type(query).__name__))
+        return cls(*components)
+
+    @property
+    def version(self):
+        """A number that grows whenever a clause of the query is replaced or changed in place.
+
+        Two reads returning the same version mean the query renders to the same string.
+        """
+        version = getattr(self, '_version', 0)
+        for component in self._components:
+            if component is not None and component.__class__ is not tuple and component._version > version:
+                version = component._version
+        return version
+
     @property
     def as_string(self):
-        string = '%s %s' % (self._select.as_string, self._from.as_string)
-        if self._where.value:
-            string += ' %s' % self._where.as_string
-        if self._group_by.value:
-            string += ' %s' % self._group_by.as_string
-        if self._having.value:
-            string += ' %s' % self._having.as_string
-        if self._order_by.value:
-            string += ' %s' % self._order_by.as_string
-        if self._limit.value:
-            string += ' %s' % self._limit.as_string
+        version = self.version
+        rendered = getattr(self, '_rendered', None)
+        if rendered is not None and rendered[0] == version:
+            return rendered[1]
+        strings = []
+        for (_, component_class), component in zip(self.component_classes, self._components):
+            if component is None:
+                continue
+            if component.__class__ is tuple:
+                strings.append(render_component_value(get_offsets_value(self._source, component), component_class.component_name))
+            elif component.value:
+                strings.append(component.as_string)
+        string = ' '.join(strings)
+        object.__setattr__(self, '_rendered', (version, string))
         return string
 
+    def iter_render(self, raw_buffers=False):
+        """Yields as_string in fragments, clause by clause, without building it whole.
+
+        Each component yields its stored pieces; clauses still backed by the buffer of from_buffer or
+        from_file are decoded in bounded chunks, or yielded as raw slices of it with raw_buffers set.
+        """
+        rendered = getattr(self, '_rendered', None)
+        if rendered is not None and rendered[0] == self.version:
+            yield rendered[1]
+            return
+        separator = ''
+        for (_, component_class), component in zip(self.component_classes, self._components):
+            if component is None:
+                continue
+            if component.__class__ is tuple:
+                fragments = iter_offsets_fragments(self._source, component, component_class.component_name)
+                if not raw_buffers:
+                    fragments = iter_decoded_fragments(fragments)
+            elif component.has_value():
+                fragments = component.iter_render()
+            else:
+                continue
+            if separator:
+                yield separator
+            separator = ' '
+            for fragment in fragments:
+                yield fragment
+
+    def write_to(self, fileobj, encoding='utf-8'):
+        """Writes as_string to fileobj fragment by fragment, encoded with encoding.
+
+        With encoding None, fileobj is a text file and is written str fragments.  With UTF-8, clauses
+        still backed by the buffer of from_buffer or from_file are written as slices of it.
+        """
+        utf_8 = encoding is not None and encoding.lower().replace('_', '-') in ('utf-8', 'utf8')
+        for fragment in self.iter_render(raw_buffers=utf_8):
+            if encoding is not None and isinstance(fragment, text_type):
+                fragment = fragment.encode(encoding)
+            fileobj.write(fragment)
+
+    def to_bytes(self):
+        """Serializes the query into the compact binary format described at dump_serialized."""
+        source = getattr(self, '_source', None)
+        clauses = []
+        for component in self._components:
+            if component is not None and component.__class__ is tuple:
+                clauses.append((serialized_raw, source[component[0]:component[1]]))
+            else:
+                clauses.append(get_serialized_clause(component))
+        return dump_serialized(self.__class__, clauses)
+
+    @classmethod
+    def from_bytes(cls, data):
+        """Loads a query serialized by to_bytes from a bytes-like buffer (bytes, bytearray or mmap).
+
+        The query keeps the class it was serialized with.  Its clauses are left as offsets into data,
+        like those of from_buffer, so data must not change while the query uses it.
+        """
+        sql_class, clauses = load_serialized(data)
+        if not issubclass(sql_class, SQL):
+            raise ValueError('Serialized data holds a %s, not an SQL object.' % sql_class.__name__)
+        components = []
+        for (_, component_class), (kind, start, end) in zip(sql_class.component_classes, clauses):
+            if kind == serialized_raw:
+                components.append((start, end))
+            else:
+                components.append(get_deserialized_component(component_class, data, kind, start, end))
+        if not components[0] and not components[1]:
+            raise ValueError('Cannot instantiate SQL object without SELECT or FROM.')
+        sql = sql_class.__new__(sql_class)
+        object.__setattr__(sql, '_source', data)
+        object.__setattr__(sql, '_components', tuple(components))
+        return sql
+
+    def tree(self):
+        """Returns the SQLTree of the query, memoized until the version of the query changes."""
+        version = self.version
+        tree = getattr(self, '_tree', None)
+        if tree is None or tree[0] != version:
+            tree = (version, SQLTree(self))
+            object.__setattr__(self, '_tree', tree)
+        return tree[1]
+
+    def fingerprint(self):
+        """Returns a Fingerprint of the query's normalized text and its stable 64-bit hash.
+
+        Queries that differ only in literal values, keyword case or whitespace share a fingerprint.
+        The result is memoized until the version of the query changes.
+        """
+        version = self.version
+        fingerprint = getattr(self, '_fingerprint', None)
+        if fingerprint is None or fingerprint[0] != version:
+            fingerprint = (version, get_fingerprint(self.as_string))
+            object.__setattr__(self, '_fingerprint', fingerprint)
+        return fingerprint[1]
+
+    def copy(self):
+        sql = self.__class__.__new__(self.__class__)
+        sql._components = tuple(component if component is None or component.__class__ is tuple else component.copy()
+                                for component in self._components)
+        if hasattr(self, '_source'):
+            sql._source = self._source
+        return sql
+
+    def get_component(self, index):
+        """Returns the component at index of component_classes for reading only.
+
+        Unlike the clause attributes, an absent clause gives the shared empty component instead of
+        one the query owns, so reading every clause does not allocate components.
+        """
+        if self._components[index] is None:
+            return empty_components[self.component_classes[index][1]]
+        return getattr(self, self.component_classes[index][0])
+
+    def freeze(self):
+        return FrozenSQL(*(self.get_component(index).value for index in range(len(self.component_classes))))
+
     def __radd__(self, other):
         return __add__(self, other)
 
     def __add__(self, other):
-        if isinstance(other, self.__class__):
-            self._select += other._select
-            self._from += other._from
-            self._where += other._where
-            self._group_by += other._group_by
-            self._having += other._having
-            self._order_by += other._order_by
-            self._limit += other._limit
+        if isinstance(other, SQL):
+            for index, (attr, _) in enumerate(self.component_classes):
+                setattr(self, attr, self.get_component(index) + other.get_component(index))
         elif isinstance(other, SQLComponent):
-            for attr, value in self.__dict__.iteritems():
-                if isinstance(other, value.__class__):
-                    value += other
+            for index, (attr, component_class) in enumerate(self.component_classes):
+                if other.component_name == component_class.component_name:
+                    setattr(self, attr, self.get_component(index) + other)
                     break
         return self
 
+    def __reduce__(self):
+        # Pickle as the plain clause values so that parsed queries travel compactly between processes.
+        return (self.__class__, tuple(self.get_component(index).value for index in range(len(self.component_classes))))
+
     def __str__(self):
         return self.as_string
 
+class FrozenSQLComponent(SQLComponent):
+    """An immutable SQLComponent: + returns a new component and leaves both operands untouched.
+
+    The new component shares this one and keeps the appended component in a persistent linked list
+    of (previous fragments, join text, component) cells, so composition is O(1) and the clause string
+    is only rendered, once, when value is first read.
+    """
+    __slots__ = ('_value', '_fragments', '_rendered')
+
+    def __init__(self, value):
+        if not value:
+            value = None
+        else:
+            self.validate_type(value)
+        object.__setattr__(self, '_value', value)
+        object.__setattr__(self, '_fragments', None)
+        object.__setattr__(self, '_rendered', None)
+        object.__setattr__(self, '_version', next(versions))
+        object.__setattr__(self, '_string', None)
+
+    @property
+    def value(self):
+        if self._fragments is None:
+            return self._value
+        if self._rendered is None:
+            object.__setattr__(self, '_rendered', ''.join(render_frozen_component(self)))
+        return self._rendered
+
+    def copy(self):
+        return self
+
+    @classmethod
+    def combine(cls, components):
+        combined = cls(None)
+        for component in components:
+            combined += component
+        return combined
+
+    def get_pieces(self):
+        if self._value is None:
+            return None
+        return list(render_frozen_component(self))
+
+    def has_value(self):
+        return bool(self._value)
+
+    def iter_render(self):
+        if self._string is not None or self._fragments is None or is_named_value(self._value, self.component_name):
+            yield self.as_string
+            return
+        yield self.component_name + ' '
+        for piece in render_frozen_component(self):
+            yield piece
+
+    def get_pieces_without_component(self):
+        return list(render_frozen_component(self, True))
+
+    def __setattr__(self, name, value):
+        raise AttributeError('%s is immutable' % self.__class__.__name__)
+
+    def __add__(self, other):
+        if isinstance(other, SQLComponent) and other.component_name == self.component_name:
+            if not isinstance(other, FrozenSQLComponent):
+                other = self.__class__(other.value)
+        elif isinstance(other, self.expected_type):
+            other = self.__class__(other)
+        else:
+            raise ValueError('Cannot produce %s from %s' % (self.__class__.__name__, type(other).__name__))
+        if other._value is None:
+            return self
+        if self._value is None:
+            return other
+        if other._fragments is None:
+            other_value_plain = other.get_value_without_component()
+        else:
+            other_value_plain = get_value_without_component_name(other._value, other.component_name)
+        component = self.__class__.__new__(self.__class__)
+        object.__setattr__(component, '_value', self._value)
+        object.__setattr__(component, '_fragments', (self._fragments, self.get_join_text(other_value_plain), other))
+        object.__setattr__(component, '_rendered', None)
+        object.__setattr__(component, '_version', next(versions))
+        object.__setattr__(component, '_string', None)
+        return component
+
+class FrozenSQLSelect(SQLSelect, FrozenSQLComponent):
+    __slots__ = ()
+
+class FrozenSQLFrom(SQLFrom, FrozenSQLComponent):
+    __slots__ = ()
+
+class FrozenSQLWhere(SQLWhere, FrozenSQLComponent):
+    __slots__ = ()
+
+class FrozenSQLGroupBy(SQLGroupBy, FrozenSQLComponent):
+    __slots__ = ()
+
+class FrozenSQLHaving(SQLHaving, FrozenSQLComponent):
+    __slots__ = ()
+
+class FrozenSQLOrderBy(SQLOrderBy, FrozenSQLComponent):
+    __slots__ = ()
+
+class FrozenSQLLimit(SQLLimit, FrozenSQLComponent):
+    __slots__ = ()
+
+class FrozenSQL(SQL):
+    """An immutable SQL: + returns a new FrozenSQL that shares every clause the addition leaves unchanged.
+
+    Instances can be shared freely between threads as a base for building variants.
+    """
+    component_classes = (
+        ('_select', FrozenSQLSelect),
+        ('_from', FrozenSQLFrom),
+        ('_where', FrozenSQLWhere),
+        ('_group_by', FrozenSQLGroupBy),
+        ('_having', FrozenSQLHaving),
+        ('_order_by', FrozenSQLOrderBy),
+        ('_limit', FrozenSQLLimit),
+    )
+    __slots__ = ()
+
+    @classmethod
+    def combine(cls, queries):
+        # Frozen components cannot be appended to in place, so combine mutable ones and freeze the result.
+        return cls(*(getattr(SQL.combine(queries), attr) for attr, _ in SQL.component_classes))
+
+    def copy(self):
+        return self
+
+    def freeze(self):
+        return self
+
+    def __setattr__(self, name, value):
+        raise AttributeError('%s is immutable' % self.__class__.__name__)
+
+    def __add__(self, other):
+        if isinstance(other, SQL):
+            components = [getattr(self, attr) + getattr(other, attr) for attr, _ in self.component_classes]
+        elif isinstance(other, SQLComponent):
+            components = [getattr(self, attr) for attr, _ in self.component_classes]
+            for index, (_, component_class) in enumerate(self.component_classes):
+                if other.component_name == component_class.component_name:
+                    components[index] = components[index] + other
+                    break
+        else:
+            return self
+        sql = self.__class__.__new__(self.__class__)
+        object.__setattr__(sql, '_components', tuple(components))
+        return sql
+
+class OptimizedSQLFrom(SQLFrom):
+    """An SQLFrom that skips the sources (and joins) it already has when added to."""
+    __slots__ = ('_keys',)
+
+    def _add_instance(self, other):
+        deduplicated_add_instance(self, other, split_sources, get_source_key)
+
+class OptimizedSQLWhere(SQLWhere):
+    """An SQLWhere that skips the predicates it already has when added to."""
+    __slots__ = ('_keys',)
+
+    def _add_instance(self, other):
+        deduplicated_add_instance(self, other, split_conjunction, normalize_expression)
+
+class OptimizedSQLHaving(SQLHaving):
+    """An SQLHaving that skips the predicates it already has when added to."""
+    __slots__ = ('_keys',)
+
+    def _add_instance(self, other):
+        deduplicated_add_instance(self, other, split_conjunction, normalize_expression)
+
+class OptimizedSQL(SQL):
+    """An SQL whose + drops duplicate WHERE/HAVING predicates and FROM sources.
+
+    Added clauses are split at top-level ands (and FROM at top-level commas and joins), and each part
+    is only appended if its normalized text is not already in the clause, which is an O(1) set lookup.
+    With pushdown_having set, HAVING predicates that only reference GROUP BY columns are moved into
+    WHERE after every addition.
+    """
+    component_classes = (
+        ('_select', SQLSelect),
+        ('_from', OptimizedSQLFrom),
+        ('_where', OptimizedSQLWhere),
+        ('_group_by', SQLGroupBy),
+        ('_having', OptimizedSQLHaving),
+        ('_order_by', SQLOrderBy),
+        ('_limit', SQLLimit),
+    )
+    pushdown_having = False
+    __slots__ = ()
+
+    def push_down_having(self):
+        """Moves the HAVING predicates that only reference GROUP BY columns into WHERE."""
+        if not self.get_component(4).value or not self.get_component(3).value:
+            return self
+        # GROUP BY has no joins, so split_sources splits it at its top-level commas.
+        grouped = set(normalize_expression(column) for _, column in split_sources(self._group_by.get_value_without_component()))
+        kept = []
+        moved = []
+        for _, predicate in split_conjunction(self._having.get_value_without_component()):
+            columns = get_referenced_columns(predicate)
+            if columns is not None and columns <= grouped:
+                moved.append(predicate)
+            else:
+                kept.append(predicate)
+        if moved:
+            self._having = self.component_classes[4][1](' and '.join(kept) or None)
+            self._where = OptimizedSQLWhere.combine([self._where] + moved)
+        return self
+
+    def __add__(self, other):
+        sql = super(OptimizedSQL, self).__add__(other)
+        if self.pushdown_having:
+            sql.push_down_having()
+        return sql
+
+# The component returned for absent clauses of frozen queries, shared by every FrozenSQL; SQLComponent.__add__
+# and component_property also use it to recognize an absent clause.
+empty_components = dict((component_class, component_class(None))
+                        for sql_class in (SQL, FrozenSQL, OptimizedSQL) for _, component_class in sql_class.component_classes)
+
+# The classes to_bytes can serialize, by the class index stored in the header.  Only ever append to it.
+serialized_classes = (
+    SQL, FrozenSQL, OptimizedSQL,
+    SQLSelect, SQLFrom, SQLWhere, SQLGroupBy, SQLHaving, SQLOrderBy, SQLLimit,
+    FrozenSQLSelect, FrozenSQLFrom, FrozenSQLWhere, FrozenSQLGroupBy, FrozenSQLHaving, FrozenSQLOrderBy, FrozenSQLLimit,
+    OptimizedSQLFrom, OptimizedSQLWhere, OptimizedSQLHaving,
+)
+serialized_class_indexes = dict((serialized_class, index) for index, serialized_class in enumerate(serialized_classes))
+
+class SQLTemplate(object):
+    """A query with named :placeholders that is parsed once and then bound to values many times.
+
+    The rendered query is split at its placeholders when the template is built, so binding only
+    interleaves the stored segments with the values.  LIMIT must be a literal number.
+    """
+    def __init__(self, sql):
+        if isinstance(sql, str):
+            sql = SQL.from_string(sql)
+        self.sql = sql
+        self.placeholders = OrderedDict()
+        self._segments = []
+        self._names = []
+        segment = ''
+        for index in range(len(SQL.component_classes)):
+            component = sql.get_component(index)
+            if not component.value:
+                continue
+            text = component.as_string
+            names = []
+            start = 0
+            for match in placeholder_pattern.finditer(text):
+                name = match.group('name')
+                if name is None:
+                    continue
+                self._segments.append(segment + text[start:match.start()])
+                self._names.append(name)
+                names.append(name)
+                segment = ''
+                start = match.end()
+            segment += text[start:] + ' '
+            self.placeholders[component.component_name] = names
+        self._segments.append(segment[:-1])
+        self._statements = {}
+
+    @property
+    def names(self):
+        return list(OrderedDict.fromkeys(self._names))
+
+    def bind(self, **params):
+        """Returns the query with every placeholder replaced by its value rendered as an SQL literal."""
+        pieces = [self._segments[0]]
+        for name, segment in zip(self._names, self._segments[1:]):
+            pieces.append(quote_literal(self.get_param(params, name)))
+            pieces.append(segment)
+        return ''.join(pieces)
+
+    def bind_params(self, params, paramstyle='qmark'):
+        """Returns a (statement, parameters) pair for a DB-API driver using paramstyle.
+
+        A list, tuple or set value is expanded into a parenthesized list with one placeholder per
+        element (named styles number them as name__1, name__2, ...), so the statement then depends on
+        the lengths of the sequences.  Empty sequences are refused, like they are by bind.
+        """
+        values = [self.get_param(params, name) for name in self._names]
+        if not any(isinstance(value, sequence_types) for value in values):
+            statement = self.get_statement(paramstyle)
+            if paramstyle in ('named', 'pyformat'):
+                return statement, dict(zip(self._names, values))
+            return statement, values
+        if paramstyle not in paramstyle_markers:
+            raise ValueError('Unknown paramstyle %s' % paramstyle)
+        marker = paramstyle_markers[paramstyle]
+        named = paramstyle in ('named', 'pyformat')
+        bound = {} if named else []
+        pieces = [self._segments[0]]
+        for name, value, segment in zip(self._names, values, self._segments[1:]):
+            if isinstance(value, sequence_types):
+                if not value:
+                    raise ValueError('Cannot bind an empty %s to :%s: () is not valid SQL.' % (type(value).__name__, name))
+                markers = []
+                for index, item in enumerate(value):
+                    item_name = '%s__%d' % (name, index + 1)
+                    markers.append(marker(item_name, len(bound) + 1))
+                    if named:
+                        bound[item_name] = item
+                    else:
+                        bound.append(item)
+                pieces.append('(%s)' % ', '.join(markers))
+            else:
+                pieces.append(marker(name, len(bound) + 1))
+                if named:
+                    bound[name] = value
+                else:
+                    bound.append(value)
+            pieces.append(segment)
+        return ''.join(pieces), bound
+
+    def bind_many(self, param_sets, paramstyle=None):
+        """Binds every mapping in param_sets.
+
+        Without a paramstyle a list of query strings is returned; with one, a single
+        (statement, list of parameters) pair suitable for a DB-API executemany.
+        """
+        if paramstyle is None:
+            return [self.bind(**params) for params in param_sets]
+        statement = None
+        bound = []
+        for params in param_sets:
+            params_statement, params = self.bind_params(params, paramstyle)
+            if statement is not None and params_statement != statement:
+                raise ValueError('Cannot bind sequences of different lengths for one executemany.')
+            statement = params_statement
+            bound.append(params)
+        return statement if statement is not None else self.get_statement(paramstyle), bound
+
+    def get_statement(self, paramstyle):
+        statement = self._statements.get(paramstyle)
+        if statement is None:
+            if paramstyle not in paramstyle_markers:
+                raise ValueError('Unknown paramstyle %s' % paramstyle)
+            marker = paramstyle_markers[paramstyle]
+            pieces = [self._segments[0]]
+            for position, (name, segment) in enumerate(zip(self._names, self._segments[1:])):
+                pieces.append(marker(name, position + 1))
+                pieces.append(segment)
+            statement = self._statements[paramstyle] = ''.join(pieces)
+        return statement
+
+    def get_param(self, params, name):
+        try:
+            return params[name]
+        except KeyError:
+            raise ValueError('No value given for placeholder :%s' % name)
+
+    def __str__(self):
+        return self.get_statement('named')
+
+class SQLVariants(object):
+    """Renders variants of one query for fanning it out over shards or partitions.
+
+    The base query is parsed and rendered once.  Each clause is kept as its rendered text, split at
+    the references to the tables that may be renamed, so a variant only re-joins the clauses its
+    substitutions touch and reuses the rest as they are.  tables defaults to every table in FROM.
+    """
+    def __init__(self, sql, tables=None):
+        if isinstance(sql, str):
+            sql = SQL.from_string(sql)
+        tree = sql.tree()
+        self.sql = sql
+        self.tables = set(get_tree_key(table) for table in (tree.tables if tables is None else tables))
+        self._clauses = []
+        for name, (keyword, nodes) in tree.clauses.items():
+            segments, slots = get_variant_segments(keyword, nodes, self.tables, name == 'FROM')
+            self._clauses.append((name, segments, slots, join_variant_segments(segments, slots, {})))
+        # A WHERE with a top-level or is parenthesized before a partition predicate is added to it.
+        predicates = split_conjunction(sql._where.get_value_without_component()) if sql._where.value else ()
+        self._where_is_disjunction = len(predicates) == 1 and predicates[0][1] != sql._where.get_value_without_component().strip()
+
+    def render(self, tables=None, where=None, limit=None):
+        """Returns the query with its tables renamed by the tables mapping, the where predicate (a string
+        or SQLWhere) added to WHERE and its LIMIT replaced by limit."""
+        strings = []
+        if where is not None:
+            where = get_variant_predicate(where)
+        for name, segments, slots, default in self._clauses:
+            string = join_variant_segments(segments, slots, tables) if slots and tables else default
+            if where is not None and component_indexes[name.lower()] >= component_indexes['where']:
+                if name != 'WHERE':
+                    strings.append('WHERE %s' % where)
+                elif self._where_is_disjunction:
+                    string = 'WHERE (%s) and %s' % (string[len('WHERE '):], where)
+                else:
+                    string = '%s and %s' % (string, where)
+                where = None
+            if name != 'LIMIT' or limit is None:
+                strings.append(string)
+        if where is not None:
+            strings.append('WHERE %s' % where)
+        if limit is not None:
+            strings.append('LIMIT %d' % limit)
+        return ' '.join(strings)
+
+    def iter_render(self, substitutions):
+        """Yields render(**substitution) for every mapping in substitutions."""
+        for substitution in substitutions:
+            yield self.render(**substitution)
+
+    def union_all(self, substitutions):
+        """Returns every variant as a single UNION ALL statement.
+
+        Variants with an ORDER BY or a LIMIT are parenthesized so that they keep applying per variant.
+        """
+        statements = []
+        for substitution in substitutions:
+            statement = self.render(**substitution)
+            if self.sql._order_by.value or self.sql._limit.value or substitution.get('limit') is not None:
+                statement = '(%s)' % statement
+            statements.append(statement)
+        return ' UNION ALL '.join(statements)
+
+class SQLTree(object):
+    """A typed syntax tree of the clauses of an SQL object, with indexes of what they reference.
+
+    clauses maps each present clause name to its (keyword text, nodes) pair; rendering the nodes
+    gives back exactly the clause's as_string.  tables and columns map every referenced table and
+    column (lower-cased unless quoted; columns both as written, unqualified and qualified with the
+    table behind an alias) to the set of clause names referencing them, including from subqueries.
+    aliases maps FROM aliases to their table (or subquery text) and SELECT aliases to their expression.
+    """
+    def __init__(self, sql):
+        clause_strings = []
+        for index in range(len(SQL.component_classes)):
+            component = sql.get_component(index)
+            if component.value:
+                clause_strings.append((component.component_name, component.as_string))
+        self.index(clause_strings)
+
+    @classmethod
+    def from_string(cls, sql_string):
+        """Builds the tree of a statement without making an SQL object of it, so that its LIMIT may be
+        anything (a :placeholder or ALL) rather than a number."""
+        clause_strings = []
+        for (_, component_class), value in zip(SQL.component_classes, tokenize_sql_component(sql_string)):
+            if value:
+                clause_strings.append((component_class.component_name, render_component_value(value, component_class.component_name)))
+        tree = cls.__new__(cls)
+        tree.index(clause_strings)
+        return tree
+
+    def index(self, clause_strings):
+        self.clauses = OrderedDict()
+        self.tables = {}
+        self.columns = {}
+        self.aliases = {}
+        for name, string in clause_strings:
+            self.clauses[name] = (string[:len(name)], parse_tree_nodes(string[len(name):]))
+        if 'FROM' in self.clauses:
+            self.index_from(self.clauses['FROM'][1])
+        for name, (_, nodes) in self.clauses.items():
+            if name == 'SELECT':
+                self.index_select(nodes)
+            elif name != 'FROM':
+                self.index_columns(name, nodes)
+
+    @property
+    def as_string(self):
+        return ' '.join(keyword + render_tree_nodes(nodes) for keyword, nodes in self.clauses.values())
+
+    def get_clauses(self, column):
+        """Returns the set of clause names that reference column."""
+        return self.columns.get(get_tree_key(column), frozenset())
+
+    def references_table(self, table):
+        return get_tree_key(table) in self.tables
+
+    def is_filtered(self, column):
+        """Tells whether column appears in WHERE or HAVING (or in a join condition)."""
+        return not self.get_clauses(column).isdisjoint(('WHERE', 'HAVING', 'FROM'))
+
+    def index_from(self, nodes):
+        for source in split_tree_nodes(nodes, lambda node: node.text == ',' or get_tree_key(node) == 'join'):
+            source = [node for node in source if node.kind != 'space']
+            while source and source[-1].kind == 'keyword' and get_tree_key(source[-1]) in join_keywords:
+                source.pop()
+            if not source:
+                continue
+            table = source[0]
+            if table.kind == 'name':
+                table_key = get_tree_key(table)
+                self.tables.setdefault(table_key, set()).add('FROM')
+            else:
+                table_key = render_tree_nodes([table])
+                self.index_columns('FROM', [table])
+            rest = source[1:]
+            if rest and get_tree_key(rest[0]) == 'as':
+                rest = rest[1:]
+            if rest and rest[0].kind == 'name':
+                self.aliases[get_tree_key(rest[0])] = table_key
+                rest = rest[1:]
+            elif table.kind == 'name':
+                self.aliases.setdefault(table_key, table_key)
+            self.index_columns('FROM', rest)
+
+    def index_select(self, nodes):
+        for item in split_tree_nodes(nodes, lambda node: node.text == ','):
+            item = [node for node in item if node.kind != 'space']
+            if len(item) > 1 and item[-1].kind == 'name' and (get_tree_key(item[-2]) == 'as' or item[-2].kind != 'symbol' and item[-2].kind != 'keyword'):
+                expression = item[:-2] if get_tree_key(item[-2]) == 'as' else item[:-1]
+                self.aliases[get_tree_key(item[-1])] = ' '.join(render_tree_nodes([node]) for node in expression)
+                item = expression
+            self.index_columns('SELECT', item)
+
+    def index_columns(self, clause_name, nodes):
+        stack = list(nodes)
+        while stack:
+            node = stack.pop()
+            if node.kind == 'name':
+                self.add_column(clause_name, get_tree_key(node))
+            elif node.kind == 'call':
+                stack.extend(node.children[1:])
+            elif node.kind == 'group':
+                stack.extend(node.children)
+            elif node.kind == 'query':
+                tree = node.children[-1]
+                for index, other in ((self.tables, tree.tables), (self.columns, tree.columns)):
+                    for key in other:
+                        index.setdefault(key, set()).add(clause_name)
+
+    def add_column(self, clause_name, column):
+        columns = [column]
+        qualifier, _, name = column.rpartition('.')
+        if qualifier:
+            if name != '*':
+                columns.append(name)
+            table = self.aliases.get(qualifier)
+            if table is not None and table != qualifier:
+                columns.append('%s.%s' % (table, name))
+        for column in columns:
+            self.columns.setdefault(column, set()).add(clause_name)
+
+class SQLParseCache(object):
+    """A thread-safe LRU cache of parsed SQL objects bounded by entry count and total statement bytes.
+
+    Entries are stored privately and copied on every hit, so mutating a returned SQL object
+    (e.g. with +=) never affects later hits.
+    """
+    def __init__(self, max_entries=1024, max_bytes=16 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries[key] = entry
+            self.hits += 1
+        return entry[0].copy()
+
+    def put(self, key, sql, size):
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self.size -= previous[1]
+            self._entries[key] = (sql, size)
+            self.size += size
+            while len(self._entries) > self.max_entries or self.size > self.max_bytes:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self.size -= evicted_size
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+class SQLDiskCache(object):
+    """A parse cache kept in a directory, shared by every process that uses the same directory.
+
+    Assign one to SQL.parse_cache like an SQLParseCache.  Each statement is stored with to_bytes in
+    a file named by a hash of its text and its SQL class, and a hit loads it with from_bytes, so nothing
+    is parsed and clauses are only decoded when they are accessed.  Entries of mmap_threshold bytes or
+    more are loaded through a read-only mmap; smaller ones are read into bytes, since every mmap holds a
+    file descriptor for as long as the query that uses it is alive.  Entries
+    are written under a temporary name and renamed into place, so readers never see a partial entry;
+    writers then hold an exclusive lock on the directory while they evict the least recently used
+    entries until the directory holds at most max_bytes.  Whether a statement was parsed lazily does
+    not matter: every hit behaves like a lazily parsed query.
+
+    Each cache keeps a running estimate of the directory's size, so a put only scans the directory
+    when the estimate goes over max_bytes or every rescan_interval puts (to notice what other
+    processes wrote).  A scan evicts down to low_water times max_bytes and removes the temporary
+    files of writers that died more than stale_seconds ago.
+    """
+    suffix = '.spq'
+    mmap_threshold = 64 * 1024
+    rescan_interval = 256
+    low_water = 0.9
+    stale_seconds = 60 * 60
+
+    def __init__(self, directory, max_bytes=64 * 1024 * 1024):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._lock_path = os.path.join(directory, '.lock')
+        self._size = None
+        self._puts = 0
+        try:
+            os.makedirs(directory)
+        except OSError:
+            if not os.path.isdir(directory):
+                raise
+
+    def get(self, key):
+        sql_class, sql_string = key[0], key[1]
+        try:
+            path = self.get_path(sql_class, sql_string)
+            with open(path, 'rb') as fileobj:
+                if os.fstat(fileobj.fileno()).st_size < self.mmap_threshold:
+                    data = fileobj.read()
+                else:
+                    data = mmap.mmap(fileobj.fileno(), 0, access=mmap.ACCESS_READ)
+            sql = SQL.from_bytes(data)
+            # Mark the entry as recently used for eviction.
+            os.utime(path, None)
+        except (IOError, OSError, mmap.error, ValueError):
+            # Missing, evicted by another process, or written by an incompatible version.
+            sql = None
+        with self._lock:
+            if sql is None or sql.__class__ is not sql_class:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return sql
+
+    def put(self, key, sql, size):
+        data = sql.to_bytes()
+        if len(data) > self.max_bytes:
+            return
+        path = self.get_path(key[0], key[1])
+        descriptor, temporary_path = tempfile.mkstemp(suffix='.tmp', dir=self.directory)
+        try:
+            with os.fdopen(descriptor, 'wb') as fileobj:
+                fileobj.write(data)
+            getattr(os, 'replace', os.rename)(temporary_path, path)
+        except BaseException:
+            try:
+                os.remove(temporary_path)
+            except OSError:
+                pass
+            raise
+        with self._lock:
+            self._puts += 1
+            if self._size is not None:
+                self._size += len(data)
+            scan = self._size is None or self._size > self.max_bytes or not self._puts % self.rescan_interval
+        if scan:
+            with self.locked():
+                self.evict()
+
+    def get_path(self, sql_class, sql_string):
+        return os.path.join(self.directory, get_disk_cache_key(sql_class, sql_string) + self.suffix)
+
+    @contextmanager
+    def locked(self):
+        """Holds the directory's lock, which serializes eviction and clearing between threads and processes."""
+        with self._write_lock:
+            with open(self._lock_path, 'a') as fileobj:
+                if fcntl is not None:
+                    fcntl.flock(fileobj.fileno(), fcntl.LOCK_EX)
+                yield
+
+    def evict(self):
+        """Scans the directory, removing stale temporary files and, when it holds more than max_bytes,
+        the least recently used entries; call with the lock held."""
+        entries = []
+        size = 0
+        stale = time.time() - self.stale_seconds
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+                if name.endswith('.tmp') and stat.st_mtime < stale:
+                    os.remove(path)
+                    continue
+            except OSError:
+                continue
+            if name.endswith(self.suffix):
+                entries.append((stat.st_mtime, path, stat.st_size))
+                size += stat.st_size
+        if size > self.max_bytes:
+            entries.sort()
+            target = self.max_bytes * self.low_water
+            for _, path, entry_size in entries:
+                if size <= target:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    continue
+                size -= entry_size
+                with self._lock:
+                    self.evictions += 1
+        with self._lock:
+            self._size = size
+
+    def iter_paths(self):
+        for name in os.listdir(self.directory):
+            if name.endswith(self.suffix):
+                yield os.path.join(self.directory, name)
+
+    def clear(self):
+        with self.locked():
+            for path in self.iter_paths():
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            with self._lock:
+                self._size = 0
+
+    def __len__(self):
+        return sum(1 for _ in self.iter_paths())
+
+class Instrumentation(object):
+    """Opt-in counters, timers and size histograms for spyql's hot paths.
+
+    Nothing is wrapped until enable() is called, so disabled instrumentation costs nothing; while
+    enabled, every call to an instrumented function is counted, timed and passed to the registered
+    callbacks as callback(name, seconds, size).  Statement and rendered sizes are bucketed by powers
+    of two in size_histograms.
+    """
+    def __init__(self):
+        self.counts = {}
+        self.seconds = {}
+        self.size_histograms = {}
+        self.callbacks = []
+        self._originals = None
+        self._enabled = 0
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self._originals is not None
+
+    def enable(self):
+        with self._lock:
+            self._enabled += 1
+            if self._originals is None:
+                self._originals = install_instrumentation(self)
+
+    def disable(self):
+        with self._lock:
+            self._enabled = max(self._enabled - 1, 0)
+            if not self._enabled and self._originals is not None:
+                for owner, name, original in self._originals:
+                    setattr(owner, name, original)
+                self._originals = None
+
+    def add_callback(self, callback):
+        self.callbacks.append(callback)
+
+    def remove_callback(self, callback):
+        self.callbacks.remove(callback)
+
+    def reset(self):
+        with self._lock:
+            self.counts.clear()
+            self.seconds.clear()
+            self.size_histograms.clear()
+
+    def record(self, name, seconds, size):
+        with self._lock:
+            self.counts[name] = self.counts.get(name, 0) + 1
+            self.seconds[name] = self.seconds.get(name, 0.0) + seconds
+            if size is not None:
+                histogram = self.size_histograms.setdefault(name, {})
+                bucket = 1 << size.bit_length() if size else 0
+                histogram[bucket] = histogram.get(bucket, 0) + 1
+        for callback in list(self.callbacks):
+            callback(name, seconds, size)
+
+    @contextmanager
+    def profile(self):
+        """Enables instrumentation for a block and yields an InstrumentationProfile of the calls made in it by this thread."""
+        profile = InstrumentationProfile()
+        self.add_callback(profile.record)
+        self.enable()
+        try:
+            yield profile
+        finally:
+            self.disable()
+            self.remove_callback(profile.record)
+
+class InstrumentationProfile(object):
+    def __init__(self):
+        self.calls = []
+        self.thread = threading.current_thread()
+
+    def record(self, name, seconds, size):
+        if threading.current_thread() is self.thread:
+            self.calls.append((name, seconds, size))
+
+    def totals(self):
+        """Returns {name: (count, seconds)} over the recorded calls."""
+        totals = {}
+        for name, seconds, _ in self.calls:
+            count, total = totals.get(name, (0, 0.0))
+            totals[name] = (count + 1, total + seconds)
+        return totals
+
+def install_instrumentation(instrumentation):
+    """Replaces the hot-path functions with timed wrappers and returns what is needed to restore them."""
+    module = sys.modules[__name__]
+    originals = []
+
+    def timed(name, function, get_size):
+        timer = timeit.default_timer
+        def wrapper(*args, **kwargs):
+            start = timer()
+            result = function(*args, **kwargs)
+            instrumentation.record(name, timer() - start, get_size(args, result))
+            return result
+        return wrapper
+
+    def statement_size(args, result):
+        return len(args[0])
+
+    def sql_string_size(args, result):
+        return len(args[1])
+
+    def result_size(args, result):
+        return len(result)
+
+    def offsets_size(args, result):
+        start, end = args[2]
+        return end - start
+
+    def no_size(args, result):
+        return None
+
+    # Lazy parses (from_string(lazy=True), from_buffer, from_file) only call tokenize_sql_offsets and
+    # build each clause through materialize_component when it is first accessed.
+    for name, get_size in (('tokenize_sql_offsets', statement_size), ('tokenize_sql_component', statement_size),
+                           ('materialize_component', offsets_size)):
+        function = getattr(module, name)
+        originals.append((module, name, function))
+        setattr(module, name, timed(name, function, get_size))
+
+    from_string = SQL.__dict__['from_string']
+    originals.append((SQL, 'from_string', from_string))
+    SQL.from_string = classmethod(timed('SQL.from_string', from_string.__func__, sql_string_size))
+
+    for owner in (SQL, SQLComponent):
+        as_string = owner.__dict__['as_string']
+        originals.append((owner, 'as_string', as_string))
+        owner.as_string = property(timed('%s.as_string' % owner.__name__, as_string.fget, result_size))
+
+    component_classes = []
+    for sql_class in (SQL, FrozenSQL, OptimizedSQL):
+        for _, component_class in sql_class.component_classes:
+            # Only the classes that override _add_instance, so that each implementation is timed once.
+            if '_add_instance' in component_class.__dict__ and component_class not in component_classes:
+                component_classes.append(component_class)
+    for component_class in component_classes:
+        add_instance = component_class.__dict__['_add_instance']
+        originals.append((component_class, '_add_instance', add_instance))
+        component_class._add_instance = timed('%s._add_instance' % component_class.__name__, add_instance, no_size)
+    return originals
+
+# Shared by the whole process; call instrumentation.enable() or use instrumentation.profile() to turn it on.
+instrumentation = Instrumentation()
+
+def parse_many(statements, workers=None, chunksize=256, lazy=False):
+    """Parses statements into SQL objects on a pool of worker processes, keeping their input order.
+
+    workers defaults to the number of CPUs; with a single worker everything is parsed in this process.
+    Returns a list, or an iterator that yields results as they arrive if lazy is set.
+    """
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    if workers <= 1:
+        parsed = (SQL.from_string(statement) for statement in statements)
+    else:
+        parsed = iter_pool_parse(statements, workers, chunksize)
+    return parsed if lazy else list(parsed)
+
+def iter_pool_parse(statements, workers, chunksize):
+    pool = multiprocessing.Pool(workers)
+    try:
+        for sql in pool.imap(parse_statement, statements, chunksize):
+            yield sql
+    finally:
+        pool.terminate()
+        pool.join()
+
+def parse_statement(statement):
+    return SQL.from_string(statement)
+
+def iter_parse(source, chunk_size=64 * 1024, use_mmap=False, skip_invalid=False):
+    """Lazily yields an SQL object for every statement in source, a file object or a path.
+
+    Statements are read in chunks of chunk_size (through mmap if use_mmap is set), so memory use is
+    bounded by the longest statement rather than the file.  Statements that cannot be parsed into
+    SQL objects raise ValueError unless skip_invalid is set.
+    """
+    for statement in iter_statements(source, chunk_size, use_mmap):
+        try:
+            sql = SQL.from_string(statement)
+        except ValueError:
+            if skip_invalid:
+                continue
+            raise
+        yield sql
+
+def iter_statements(source, chunk_size=64 * 1024, use_mmap=False):
+    """Yields the statements in source, split at semicolons outside of parentheses, quotes and comments.
+
+    Comments are replaced with a space and surrounding whitespace is stripped; empty statements are skipped.
+    """
+    for statement in split_statements(iter_chunks(source, chunk_size, use_mmap)):
+        statement = statement.strip()
+        if statement:
+            yield statement
+
+def iter_chunks(source, chunk_size, use_mmap=False):
+    fileobj = open(source) if isinstance(source, str) else source
+    try:
+        if use_mmap:
+            size = os.fstat(fileobj.fileno()).st_size
+            if not size:
+                return
+            mapped = mmap.mmap(fileobj.fileno(), 0, access=mmap.ACCESS_READ)
+            # The splitter works on str, so on Python 3 the mapped bytes are decoded as UTF-8; the
+            # incremental decoder carries characters that straddle two chunks over to the next one.
+            decoder = None if bytes is str else codecs.getincrementaldecoder('utf-8')()
+            try:
+                for offset in range(0, size, chunk_size):
+                    chunk = mapped[offset:offset + chunk_size]
+                    yield chunk if decoder is None else decoder.decode(chunk, offset + chunk_size >= size)
+            finally:
+                mapped.close()
+        else:
+            while True:
+                chunk = fileobj.read(chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+    finally:
+        if fileobj is not source:
+            fileobj.close()
+
+def split_statements(chunks):
+    state = None
+    left_parens = 0
+    pieces = []
+    carry = ''
+    for chunk in chunks:
+        text = carry + chunk if carry else chunk
+        carry = ''
+        end = len(text)
+        start = 0
+        position = 0
+        while True:
+            match = statement_splitter_patterns[state].search(text, position)
+            if match is None:
+                break
+            token = match.group()
+            position = match.end()
+            if position == end and token in ('-', '/', '*', '\\'):
+                end = match.start()
+                carry = text[end:]
+                break
+            if state is None:
+                if token == ';':
+                    if not left_parens:
+                        pieces.append(text[start:match.start()])
+                        yield ''.join(pieces)
+                        pieces = []
+                        start = position
+                elif token == '(':
+                    left_parens += 1
+                elif token == ')':
+                    left_parens -= 1
+                elif token in ('--', '/*'):
+                    pieces.append(text[start:match.start()])
+                    pieces.append(' ')
+                    state = token
+                else:
+                    state = token
+            elif token == '\\':
+                position += 1
+            elif state == '--':
+                state = None
+                start = match.start()
+            elif state == '/*':
+                state = None
+                start = position
+            else:
+                state = None
+        if state not in ('--', '/*'):
+            pieces.append(text[start:end])
+    if carry and state not in ('--', '/*'):
+        pieces.append(carry)
+    yield ''.join(pieces)
+
 def tokenize_sql_component(statement):
-    component_names = {
-        'select':0,
-        'from':1,
-        'where':2,
-        'group by':3,
-        'having':4,
-        'order by':5,
-        'limit':6
-    }
-    component_index = -1
-    components = ['' for x in range(len(component_names.keys()))]
+    return [get_offsets_value(statement, offsets) for offsets in tokenize_sql_offsets(statement)]
+
+def tokenize_sql_offsets(statement):
+    """Returns a (start, end) slice of statement for each of component_names, or None if the clause is absent.
+
+    The statement is walked once; a clause keyword only opens a clause outside of parentheses and quotes,
+    and only the first time it is seen.
+    """
+    offsets = [None] * len(component_names)
+    end = len(statement)
+    while end and statement[end - 1:end] in trailing_characters:
+        end -= 1
     left_parens = 0
-    word = ''
-    statement = statement.replace('\n', ' ').replace('\t', ' ').strip()
-    for char in statement:
-        if not left_parens and word.lower().strip() in component_names:
-            component_index = component_names[word.lower().strip()]
-        if char == '(':
+    component_index = -1
+    component_start = 0
+    pattern = tokenizer_pattern if isinstance(statement, str) else tokenizer_bytes_pattern
+    for match in pattern.finditer(statement, 0, end):
+        kind = match.lastgroup
+        if kind == 'open':
             left_parens += 1
-        elif char == ')':
+        elif kind == 'close':
             left_parens -= 1
-        if char in [' '] and not filter(lambda x: ' ' in x and word.lower() in x, component_names.keys()):
-            word = ''
-        else:
-            word += char
-        if component_index != -1 and char != ';':
-            components[component_index] += char
-    def get_components_without_useless_characters(components):
-        cleaned_components = []
-        for component in components:
-            component = component.strip()
-            for component_name in component_names.keys():
-                if component.lower().endswith(component_name):
-                    component = delete_last_occurence(component, component_name).strip()
-            cleaned_components.append(component)
-        return cleaned_components
-    plain_components = get_components_without_useless_characters(components)
-    return plain_components
+        elif kind == 'keyword' and not left_parens:
+            index = component_indexes[' '.join(decode_buffer(match.group(kind)).lower().split())]
+            if offsets[index] is not None:
+                continue
+            if component_index != -1:
+                offsets[component_index] = strip_offsets(statement, component_start, match.start())
+            component_index = index
+            component_start = match.end()
+            offsets[index] = ()
+    if component_index != -1:
+        offsets[component_index] = strip_offsets(statement, component_start, end)
+    return offsets
+
+def strip_offsets(statement, start, end):
+    if not isinstance(statement, str):
+        # bytes() because a memoryview has no isspace; only a byte is copied at a time.
+        while start < end and bytes(statement[start:start + 1]).isspace():
+            start += 1
+        while end > start and bytes(statement[end - 1:end]).isspace():
+            end -= 1
+        return (start, end)
+    while start < end and statement[start].isspace():
+        start += 1
+    while end > start and statement[end - 1].isspace():
+        end -= 1
+    return (start, end)
+
+def materialize_component(component_class, statement, offsets):
+    """Builds the component of a lazily parsed clause from its offsets into statement."""
+    return component_class(get_offsets_value(statement, offsets))
+
+def get_offsets_value(statement, offsets):
+    if not offsets:
+        return ''
+    start, end = offsets
+    return decode_buffer(statement[start:end]).replace('\n', ' ').replace('\t', ' ')
+
+def decode_buffer(value):
+    """Returns a slice of a statement or buffer as a str, decoding bytes as UTF-8 on Python 3."""
+    if isinstance(value, str):
+        return value
+    value = value.tobytes() if isinstance(value, memoryview) else bytes(value)
+    return value if bytes is str else value.decode('utf-8')
+
+def iter_offsets_fragments(source, offsets, component_name):
+    """Yields the rendered clause at offsets of source in pieces.
+
+    For buffers the clause is yielded as memoryview slices of it (or plain slices where the buffer
+    does not support memoryview) with a space for each newline and tab, like get_offsets_value does.
+    """
+    start, end = offsets
+    if isinstance(source, str) or decode_buffer(source[start:start + len(component_name)]).upper() == component_name:
+        yield render_component_value(get_offsets_value(source, offsets), component_name)
+        return
+    try:
+        view = memoryview(source)
+    except TypeError:
+        view = source
+    yield component_name + ' '
+    for match in clause_whitespace_bytes_pattern.finditer(source, start, end):
+        yield view[start:match.start()]
+        yield b' '
+        start = match.end()
+    yield view[start:end]
 
 def basic_add_instance(sql_component, other):
-    if not sql_component.value:
-        sql_component.value = other.value
+    pieces = sql_component._pieces
+    if pieces is None:
+        sql_component._pieces = other.value
     else:
-        other_value_plain = other.get_value_without_component()
-        sql_component.value += ', %s' % other_value_plain
+        other_pieces = other.get_pieces_without_component()
+        # Before touching _pieces, so a join that raises (a second LIMIT) leaves the component intact.
+        join_text = sql_component.get_join_text(other_pieces[0])
+        if pieces.__class__ is not list:
+            pieces = sql_component._pieces = [pieces]
+        pieces.append(join_text)
+        pieces.extend(other_pieces)
+    sql_component.changed()
+
+def deduplicated_add_instance(sql_component, other, split, get_key):
+    """Appends the parts of other (as split by split) whose key sql_component does not have yet.
+
+    The keys of sql_component's own parts are kept in its _keys slot, along with the version they
+    were computed for.
+    """
+    keys = getattr(sql_component, '_keys', None)
+    rewritten = None
+    if keys is not None and keys[0] == sql_component._version:
+        keys = keys[1]
+    elif sql_component.value:
+        value = sql_component.get_value_without_component()
+        parts = split(value)
+        keys = set(get_key(part) for _, part in parts)
+        if len(parts) == 1 and parts[0][1] != value.strip():
+            rewritten = parts[0][1]
+    else:
+        keys = set()
+    pieces = sql_component._pieces
+    if pieces is not None and pieces.__class__ is not list:
+        pieces = [pieces]
+    for separator, part in split(other.get_value_without_component()):
+        key = get_key(part)
+        if key in keys:
+            continue
+        keys.add(key)
+        if rewritten is not None:
+            pieces = [rewritten]
+            rewritten = None
+        if pieces is None:
+            pieces = [part] if separator in (None, ',') else [separator.lstrip(), part]
+        elif separator in (None, ','):
+            pieces.extend((sql_component.get_join_text(part), part))
+        else:
+            pieces.extend((' ' + separator.lstrip(), part))
+    sql_component._pieces = pieces
+    sql_component.changed()
+    sql_component._keys = (sql_component._version, keys)
+
+def split_conjunction(value):
+    """Splits value at its top-level ands into a list of (None, predicate) pairs.
+
+    The and of a BETWEEN and the ands inside CASE or parentheses are not split at.  A value with a
+    top-level or is kept whole and parenthesized, so that it keeps its meaning when joined with and.
+    """
+    predicates = []
+    depth = 0
+    cases = 0
+    between = False
+    start = 0
+    for match in conjunction_pattern.finditer(value):
+        if match.group('open'):
+            depth += 1
+        elif match.group('close'):
+            depth -= 1
+        elif match.group('word') and depth == 0:
+            word = match.group('word').lower()
+            if word == 'case':
+                cases += 1
+            elif word == 'end':
+                cases -= 1
+            elif cases:
+                continue
+            elif word == 'between':
+                between = True
+            elif word == 'or':
+                return [(None, '(%s)' % value.strip())]
+            elif between:
+                between = False
+            else:
+                predicates.append((None, value[start:match.start()].strip()))
+                start = match.end()
+    predicates.append((None, value[start:].strip()))
+    return [(separator, predicate) for separator, predicate in predicates if predicate]
+
+def split_sources(value):
+    """Splits a FROM value into (separator, source) pairs at its top-level commas and joins.
+
+    separator is None for the first source, ',' or the join keyword (e.g. 'left outer join ') that
+    the source follows; a joined source keeps its ON or USING condition.
+    """
+    sources = []
+    depth = 0
+    separator = None
+    start = 0
+    for match in source_separator_pattern.finditer(value):
+        if match.group('open'):
+            depth += 1
+        elif match.group('close'):
+            depth -= 1
+        elif match.group('separator') and depth == 0:
+            sources.append((separator, value[start:match.start()].strip()))
+            separator = match.group('separator')
+            separator = ',' if separator == ',' else separator + ' '
+            start = match.end()
+    sources.append((separator, value[start:].strip()))
+    return [(separator, source) for separator, source in sources if source or separator not in (None, ',')]
+
+def get_source_key(source):
+    """Returns the normalized source with its alias, so that 'b AS x' and 'b x' are the same source."""
+    tokens = [token for token in normalize_expression(source).split(' ') if token != 'as']
+    return ' '.join(tokens)
+
+def normalize_expression(expression):
+    """Lower-cases expression outside of quotes and drops the whitespace that does not separate words."""
+    tokens = []
+    space = False
+    for match in expression_token_pattern.finditer(expression):
+        kind = match.lastgroup
+        if kind == 'space':
+            space = True
+            continue
+        token = match.group()
+        if kind != 'quoted':
+            token = token.lower()
+        if space and tokens and kind != 'other' and tokens[-1][0] != 'other':
+            tokens.append(('space', ' '))
+        tokens.append((kind, token))
+        space = False
+    return ''.join(token for _, token in tokens)
+
+def get_referenced_columns(expression):
+    """Returns the set of normalized column names expression references, or None if it calls a function."""
+    columns = set()
+    tokens = [match for match in expression_token_pattern.finditer(expression) if match.lastgroup != 'space']
+    for index, match in enumerate(tokens):
+        if match.lastgroup == 'word':
+            word = match.group().lower()
+            if index + 1 < len(tokens) and tokens[index + 1].group() == '(':
+                return None
+            if word not in fingerprint_keywords:
+                columns.add(word)
+        elif match.lastgroup == 'quoted' and match.group()[0] in '"`':
+            columns.add(match.group())
+    return columns
+
+def parse_tree_nodes(text):
+    """Parses an expression into a list of SQLTree nodes, nesting parenthesized groups and calls."""
+    stack = [[]]
+    for match in expression_token_pattern.finditer(text):
+        kind = match.lastgroup
+        token = match.group()
+        nodes = stack[-1]
+        if kind == 'number' or kind == 'quoted' and token[0] == "'":
+            nodes.append(Node('literal', token, None))
+        elif kind == 'quoted':
+            nodes.append(Node('name', token, None))
+        elif kind == 'word':
+            nodes.append(Node('keyword' if token.lower() in tree_keywords else 'name', token, None))
+        elif token == '(':
+            stack.append([Node('symbol', token, None)])
+        elif token == ')' and len(stack) > 1:
+            nodes.append(Node('symbol', token, None))
+            stack.pop()
+            add_tree_group(stack[-1], nodes)
+        else:
+            nodes.append(Node('space' if kind == 'space' else 'symbol', token, None))
+    while len(stack) > 1:
+        # An unclosed parenthesis: keep what follows it as a group so that the text still round-trips.
+        nodes = stack.pop()
+        add_tree_group(stack[-1], nodes)
+    return stack[0]
+
+def add_tree_group(nodes, children):
+    inner = [node for node in children[1:-1] if node.kind != 'space']
+    if inner and inner[0].kind == 'keyword' and inner[0].text.lower() == 'select':
+        text = render_tree_nodes(children[1:-1] if children[-1].text == ')' else children[1:])
+        children = children + [SQLTree.from_string(text)]
+        nodes.append(Node('query', None, tuple(children)))
+    elif nodes and nodes[-1].kind == 'name':
+        nodes[-1] = Node('call', None, (nodes[-1], Node('group', None, tuple(children))))
+    else:
+        nodes.append(Node('group', None, tuple(children)))
+
+def render_tree_nodes(nodes):
+    pieces = []
+    stack = list(reversed(nodes))
+    while stack:
+        node = stack.pop()
+        if node.__class__ is not Node:
+            continue
+        if node.children is None:
+            pieces.append(node.text)
+        else:
+            stack.extend(reversed(node.children))
+    return ''.join(pieces)
+
+def split_tree_nodes(nodes, is_separator):
+    parts = [[]]
+    for node in nodes:
+        if is_separator(node):
+            parts.append([])
+        else:
+            parts[-1].append(node)
+    return parts
+
+def get_tree_key(node):
+    text = node if isinstance(node, str) else node.text
+    if text is None:
+        return None
+    return text if text[0] in '"`' else text.lower()
+
+def get_variant_segments(keyword, nodes, tables, is_from):
+    """Splits a clause's rendered text at its references to tables.
+
+    Returns the text segments and, for each gap between two of them, a (table, suffix) slot: a table
+    name (only matched in FROM and in subqueries) or the table qualifier of a column such as t.a.
+    """
+    segments = [keyword]
+    slots = []
+    stack = [(node, is_from) for node in reversed(nodes)]
+    while stack:
+        node, in_from = stack.pop()
+        if node.__class__ is not Node:
+            continue
+        if node.children is not None:
+            in_query = in_from or node.kind == 'query'
+            stack.extend((child, in_query) for child in reversed(node.children))
+            continue
+        key = get_tree_key(node) if node.kind == 'name' else None
+        qualifier, dot, name = (key or '').partition('.')
+        if key in tables and in_from:
+            slots.append((key, ''))
+        elif dot and qualifier in tables:
+            slots.append((qualifier, node.text[len(qualifier):]))
+        else:
+            segments[-1] += node.text
+            continue
+        segments.append('')
+    return segments, slots
+
+def join_variant_segments(segments, slots, tables):
+    pieces = [segments[0]]
+    for (table, suffix), segment in zip(slots, segments[1:]):
+        pieces.append(tables.get(table, table) + suffix)
+        pieces.append(segment)
+    return ''.join(pieces)
+
+def get_variant_predicate(where):
+    if isinstance(where, SQLComponent):
+        where = where.get_value_without_component()
+    return ' and '.join(predicate for _, predicate in split_conjunction(where))
+
+def render_frozen_component(component, without_component_name=False):
+    """Yields the pieces of a FrozenSQLComponent's value in order without recursing."""
+    stack = [(component, without_component_name)]
+    while stack:
+        item = stack.pop()
+        if not isinstance(item, tuple):
+            yield item
+            continue
+        component, without_component_name = item
+        if without_component_name:
+            yield get_value_without_component_name(component._value, component.component_name)
+        else:
+            yield component._value
+        fragments = component._fragments
+        while fragments is not None:
+            fragments, join_text, appended = fragments
+            stack.append((appended, True))
+            stack.append(join_text)
+
+def get_fingerprint(statement):
+    parts = []
+    end = 0
+    for match in fingerprint_pattern.finditer(statement):
+        parts.append(statement[end:match.start()])
+        kind = match.lastgroup
+        if kind == 'list':
+            parts.append('(?)')
+        elif kind == 'literal':
+            parts.append('?')
+        elif kind == 'space':
+            parts.append(' ')
+        elif kind == 'word':
+            word = match.group()
+            parts.append(word.upper() if word.lower() in fingerprint_keywords else word)
+        else:
+            parts.append(match.group())
+        end = match.end()
+    parts.append(statement[end:])
+    text = ''.join(parts).strip()
+    encoded = text if isinstance(text, bytes) else text.encode('utf-8')
+    return Fingerprint(struct.unpack('>Q', hashlib.md5(encoded).digest()[:8])[0], text)
+
+def dump_serialized(serialized_class, clauses):
+    """Packs (kind, value) clauses into the binary format of to_bytes.
+
+    The format is a header (magic, format version, index of the class in serialized_classes and
+    body length), one (kind, start, end) entry per clause with the offsets of its value in the data,
+    and a body of the UTF-8 encoded values.  Raw values are clause text as found in a statement,
+    which loads lazily; exact values are component values that must be kept as they are, and
+    integers are LIMITs.
+    """
+    entries = []
+    body = []
+    offset = serialized_header.size + serialized_clause.size * len(clauses)
+    for kind, value in clauses:
+        if kind == serialized_absent:
+            entries.append(serialized_clause.pack(kind, 0, 0))
+            continue
+        if kind == serialized_integer:
+            value = str(value)
+        value = encode_buffer(value)
+        entries.append(serialized_clause.pack(kind, offset, offset + len(value)))
+        body.append(value)
+        offset += len(value)
+    body_size = offset - serialized_header.size - serialized_clause.size * len(clauses)
+    header = serialized_header.pack(serialized_magic, serialized_version, serialized_class_indexes[serialized_class], body_size)
+    return b''.join([header] + entries + body)
+
+def load_serialized(data):
+    """Returns the class and the (kind, start, end) clauses of data serialized by dump_serialized."""
+    if len(data) < serialized_header.size:
+        raise ValueError('Serialized data is truncated.')
+    magic, version, class_index, body_size = serialized_header.unpack_from(data, 0)
+    if magic != serialized_magic:
+        raise ValueError('Data is not a serialized spyql object.')
+    if version != serialized_version:
+        raise ValueError('Unsupported serialization format version %d.' % version)
+    if class_index >= len(serialized_classes):
+        raise ValueError('Unknown serialized class %d.' % class_index)
+    serialized_class = serialized_classes[class_index]
+    count = len(serialized_class.component_classes) if issubclass(serialized_class, SQL) else 1
+    body_start = serialized_header.size + serialized_clause.size * count
+    if len(data) < body_start + body_size:
+        raise ValueError('Serialized data is truncated.')
+    clauses = [serialized_clause.unpack_from(data, serialized_header.size + serialized_clause.size * index) for index in range(count)]
+    body_end = body_start + body_size
+    for kind, start, end in clauses:
+        if kind > serialized_integer:
+            raise ValueError('Unknown serialized clause kind %d.' % kind)
+        if kind != serialized_absent and not body_start <= start <= end <= body_end:
+            raise ValueError('Serialized clause offsets (%d, %d) are outside of the body.' % (start, end))
+    return serialized_class, clauses
+
+def get_serialized_clause(component):
+    value = None if component is None else component.value
+    if not value:
+        return (serialized_absent, None)
+    if isinstance(value, numbers.Integral):
+        return (serialized_integer, value)
+    # Raw clauses have their newlines and tabs turned into spaces when they are loaded.
+    if '\n' in value or '\t' in value:
+        return (serialized_exact, value)
+    return (serialized_raw, value)
+
+def get_deserialized_component(component_class, data, kind, start, end):
+    if kind == serialized_absent:
+        return None
+    value = decode_buffer(data[start:end])
+    if kind == serialized_integer:
+        return component_class(int(value))
+    if kind == serialized_raw:
+        value = value.replace('\n', ' ').replace('\t', ' ')
+    return component_class(value)
+
+def encode_buffer(value):
+    """Returns a str or a slice of a buffer as UTF-8 encoded bytes (the inverse of decode_buffer)."""
+    if isinstance(value, text_type):
+        return value.encode('utf-8')
+    if isinstance(value, memoryview):
+        return value.tobytes()
+    return bytes(value)
+
+def get_disk_cache_key(sql_class, sql_string):
+    encoded = encode_buffer(sql_string)
+    return hashlib.sha1(sql_class.__name__.encode('ascii') + b'\0' + encoded).hexdigest()
+
+def quote_literal(value):
+    if value is None:
+        return 'NULL'
+    if isinstance(value, bool):
+        return 'TRUE' if value else 'FALSE'
+    if isinstance(value, float):
+        return repr(value)
+    if isinstance(value, numbers.Number):
+        return str(value)
+    if isinstance(value, sequence_types):
+        if not value:
+            raise ValueError('Cannot inline an empty %s: () is not valid SQL.' % type(value).__name__)
+        return '(%s)' % ', '.join(quote_literal(item) for item in value)
+    if not isinstance(value, (str, type(u''))):
+        value = str(value)
+    if '\\' in value:
+        # Dialects disagree on whether a backslash escapes inside a literal (see set_backslash_escapes),
+        # so no quoting is safe everywhere; such values must go through bind_params.
+        raise ValueError('Cannot inline %r as a literal: it contains a backslash; use bind_params.' % value)
+    return "'%s'" % value.replace("'", "''")
+
+def is_named_value(value, component_name):
+    """Tells whether render_component_value would upper-case the component name inside value."""
+    return not isinstance(value, numbers.Number) and value[:len(component_name)].upper() == component_name
+
+def iter_decoded_fragments(fragments, chunk_size=64 * 1024):
+    """Decodes the buffer slices among fragments into str, chunk_size bytes at a time at most."""
+    for fragment in fragments:
+        if isinstance(fragment, (str, text_type)):
+            yield fragment
+            continue
+        start = 0
+        size = len(fragment)
+        while start < size:
+            end = min(start + chunk_size, size)
+            # Never split a UTF-8 sequence: back up over continuation bytes.
+            while end < size and bytearray(fragment[end:end + 1])[0] & 0xC0 == 0x80:
+                end -= 1
+            yield decode_buffer(fragment[start:end])
+            start = end
 
-def delete_last_occurence(s, occurence):
-    i = get_index_of_last_occurence(s, occurence)
-    return s[:i]
+def render_component_value(value, component_name):
+    if value[:len(component_name)].upper() != component_name:
+        return '%s %s' % (component_name, value)
+    return get_upper_cased_component_value(value, component_name)
 
-def get_index_of_last_occurence(s, occurence):
-    return s.lower().rfind(occurence)
+def get_value_without_component_name(value, component_name):
+    if value.upper().startswith(component_name):
+        return value[len(component_name):].strip()
+    return value
 
 def get_upper_cased_component_value(value, component_name):
     return value.replace(component_name.lower(), component_name, 1)
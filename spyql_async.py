@@ -0,0 +1,107 @@
+"""An asyncio front-end for spyql and spyql_executor (Python 3 only).
+
+Parsing large statements and running queries both block, so they are handed to an executor and
+awaited instead of being run on the event loop.
+"""
+import asyncio
+import collections
+import functools
+
+from spyql import SQL
+
+# Statements shorter than this many characters are parsed on the loop; handing them off costs more.
+aparse_threshold = 64 * 1024
+
+async def aparse(sql_string, lazy=False, threshold=None, executor=None):
+    """Parses sql_string like SQL.from_string without blocking the event loop on large statements.
+
+    Statements of threshold characters or more are parsed on executor (the loop's default thread
+    pool when None; pass a ProcessPoolExecutor to parse them in parallel).
+    """
+    if threshold is None:
+        threshold = aparse_threshold
+    if len(sql_string) < threshold:
+        return SQL.from_string(sql_string, lazy)
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(executor, functools.partial(SQL.from_string, sql_string, lazy))
+
+class AsyncExecutor(object):
+    """Runs queries on a spyql_executor.Executor from asyncio, at most concurrency of them at a time.
+
+    The blocking DB-API calls are made on thread_pool (the loop's default thread pool when None), which
+    should have at least concurrency threads.
+    """
+    def __init__(self, executor, concurrency=4, thread_pool=None):
+        if concurrency < 1:
+            raise ValueError('An AsyncExecutor needs a concurrency of at least 1.')
+        self.executor = executor
+        self.concurrency = concurrency
+        self.thread_pool = thread_pool
+        self._semaphore = None
+
+    @property
+    def semaphore(self):
+        # Created on first use so that it belongs to the running loop.
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+        return self._semaphore
+
+    async def fetch_all(self, query, params=None):
+        """Returns all the rows of query as a list."""
+        rows = []
+        batches = self.iter_batches(query, params)
+        try:
+            async for batch in batches:
+                rows.extend(batch)
+        finally:
+            await batches.aclose()
+        return rows
+
+    async def iter_batches(self, query, params=None, batch_size=None):
+        """Yields the rows of query in batches; the next batch is only fetched once it is asked for."""
+        loop = asyncio.get_running_loop()
+        async with self.semaphore:
+            batches = self.executor.iter_batches(query, params, batch_size)
+            fetch = None
+            try:
+                while True:
+                    fetch = loop.run_in_executor(self.thread_pool, next, batches, None)
+                    batch = await asyncio.shield(fetch)
+                    if batch is None:
+                        break
+                    yield batch
+            finally:
+                if fetch is not None and not fetch.done():
+                    # Cancelled mid-fetch: the thread is still inside the generator, so let it finish first.
+                    await asyncio.wait([fetch])
+                await loop.run_in_executor(self.thread_pool, batches.close)
+
+    async def run(self, query, params=None):
+        """Runs a statement that returns no rows and returns its rowcount."""
+        loop = asyncio.get_running_loop()
+        async with self.semaphore:
+            return await loop.run_in_executor(self.thread_pool, self.executor.run, query, params)
+
+    async def map(self, queries, max_pending=None):
+        """Yields the rows of each query in queries, in order, running up to concurrency of them at once.
+
+        Each item of queries is a query or a (query, params) pair.  queries is consumed lazily: at most
+        max_pending (by default twice the concurrency) results are fetched ahead of the consumer.
+        """
+        if max_pending is None:
+            max_pending = 2 * self.concurrency
+        pending = collections.deque()
+        try:
+            for query in queries:
+                params = None
+                if isinstance(query, tuple):
+                    query, params = query
+                pending.append(asyncio.ensure_future(self.fetch_all(query, params)))
+                if len(pending) >= max_pending:
+                    yield await pending.popleft()
+            while pending:
+                yield await pending.popleft()
+        finally:
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
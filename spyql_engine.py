@@ -0,0 +1,799 @@
+"""Runs SQL objects against in-memory data, without a database.
+
+The clauses of a query are compiled once into a Plan that is then run over record batches: dicts
+mapping each column name to a list of values, as produced by iter_record_batches (from an iterable
+of dicts) and iter_csv_batches (from a CSV file with a header row).  Input is streamed one batch at
+a time, so memory stays bounded by the batch size, the number of groups and the LIMIT.
+
+WHERE is evaluated over a whole batch into a mask, GROUP BY is a hash aggregation, and ORDER BY
+with a LIMIT keeps only the top rows.  FROM is not looked at: the batches are the table.  NULLs
+follow SQL's three-valued logic.
+"""
+import csv
+import heapq
+import io
+import itertools
+import math
+import operator
+import re
+import sys
+from collections import OrderedDict
+
+import spyql
+from spyql import SQL, normalize_expression
+
+aggregate_names = frozenset(['count', 'sum', 'avg', 'min', 'max'])
+multi_character_operators = ('<=', '>=', '<>', '!=', '||', '==')
+comparison_operators = {'=': 'eq', '==': 'eq', '<>': 'ne', '!=': 'ne', '<': 'lt', '>': 'gt', '<=': 'le', '>=': 'ge'}
+arithmetic_operators = {'+': 'add', '-': 'sub', '*': 'mul', '/': 'div', '%': 'mod', '||': 'concat'}
+# Compiled LIKE patterns by pattern text, cleared once it holds like_patterns_max of them.
+like_patterns = {}
+like_patterns_max = 512
+
+def null_safe(function):
+    def null_safe_function(left, right):
+        if left is None or right is None:
+            return None
+        return function(left, right)
+    return null_safe_function
+
+def divide(left, right):
+    if isinstance(left, int) and isinstance(right, int):
+        quotient = abs(left) // abs(right)
+        return quotient if (left < 0) == (right < 0) else -quotient
+    return left / right
+
+def modulo(left, right):
+    # The sign follows the dividend, as with divide's truncation toward zero.
+    if isinstance(left, int) and isinstance(right, int):
+        return left - right * divide(left, right)
+    return math.fmod(left, right)
+
+def logical_and(left, right):
+    if left is None or right is None:
+        return False if left is False or right is False or (left is not None and not left) or (right is not None and not right) else None
+    return bool(left and right)
+
+def logical_or(left, right):
+    if left is None or right is None:
+        return True if (left is not None and left) or (right is not None and right) else None
+    return bool(left or right)
+
+def logical_not(value):
+    return None if value is None else not value
+
+def like(value, pattern):
+    if value is None or pattern is None:
+        return None
+    compiled = like_patterns.get(pattern)
+    if compiled is None:
+        if len(like_patterns) >= like_patterns_max:
+            like_patterns.clear()
+        expression = ''.join('.*' if character == '%' else '.' if character == '_' else re.escape(character) for character in pattern)
+        compiled = like_patterns[pattern] = re.compile(expression + r'\Z', re.IGNORECASE | re.DOTALL)
+    return compiled.match(value) is not None
+
+def in_list(value, values):
+    if value is None:
+        return None
+    if value in values:
+        return True
+    return None if None in values else False
+
+def coalesce(*values):
+    for value in values:
+        if value is not None:
+            return value
+    return None
+
+def case(*branches):
+    """Evaluates CASE WHEN: branches are (condition, value) pairs and an optional trailing else value."""
+    for index in range(0, len(branches) - 1, 2):
+        if branches[index]:
+            return branches[index + 1]
+    return branches[-1] if len(branches) % 2 else None
+
+# What generated code can call, by name.
+runtime = {
+    'eq': null_safe(operator.eq), 'ne': null_safe(operator.ne), 'lt': null_safe(operator.lt),
+    'gt': null_safe(operator.gt), 'le': null_safe(operator.le), 'ge': null_safe(operator.ge),
+    'add': null_safe(operator.add), 'sub': null_safe(operator.sub), 'mul': null_safe(operator.mul),
+    'div': null_safe(divide), 'mod': null_safe(modulo), 'concat': null_safe(lambda left, right: '%s%s' % (left, right)),
+    'neg': lambda value: None if value is None else -value,
+    'and_': logical_and, 'or_': logical_or, 'not_': logical_not, 'like': like, 'in_list': in_list, 'case': case,
+    'f_lower': lambda value: None if value is None else value.lower(),
+    'f_upper': lambda value: None if value is None else value.upper(),
+    'f_length': lambda value: None if value is None else len(value),
+    'f_abs': lambda value: None if value is None else abs(value),
+    'f_round': lambda value, digits=0: None if value is None else round(value, digits),
+    'f_coalesce': coalesce,
+}
+scalar_functions = dict((name[2:], name) for name in runtime if name.startswith('f_'))
+
+class Count(object):
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def add(self, value):
+        if value is not None:
+            self.value += 1
+
+    def result(self):
+        return self.value
+
+class Sum(object):
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = None
+
+    def add(self, value):
+        if value is not None:
+            self.value = value if self.value is None else self.value + value
+
+    def result(self):
+        return self.value
+
+class Avg(object):
+    __slots__ = ('total', 'count')
+
+    def __init__(self):
+        self.total = 0
+        self.count = 0
+
+    def add(self, value):
+        if value is not None:
+            self.total += value
+            self.count += 1
+
+    def result(self):
+        return float(self.total) / self.count if self.count else None
+
+class Min(object):
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = None
+
+    def add(self, value):
+        if value is not None and (self.value is None or value < self.value):
+            self.value = value
+
+    def result(self):
+        return self.value
+
+class Max(Min):
+    __slots__ = ()
+
+    def add(self, value):
+        if value is not None and (self.value is None or value > self.value):
+            self.value = value
+
+class Distinct(object):
+    """Feeds every distinct non-NULL value once to the wrapped aggregate."""
+    __slots__ = ('aggregate', 'seen')
+
+    def __init__(self, aggregate):
+        self.aggregate = aggregate
+        self.seen = set()
+
+    def add(self, value):
+        if value not in self.seen:
+            self.seen.add(value)
+            self.aggregate.add(value)
+
+    def result(self):
+        return self.aggregate.result()
+
+aggregate_classes = {'count': Count, 'sum': Sum, 'avg': Avg, 'min': Min, 'max': Max}
+
+class Descending(object):
+    """Reverses the order of a sort key."""
+    __slots__ = ('key',)
+
+    def __init__(self, key):
+        self.key = key
+
+    def __lt__(self, other):
+        return other.key < self.key
+
+    def __eq__(self, other):
+        return self.key == other.key
+
+class RowContext(object):
+    """Compiles expressions evaluated once per input row: columns become the variables v0, v1, ..."""
+    def __init__(self):
+        self.columns = []
+
+    def resolve(self, name):
+        if name not in self.columns:
+            self.columns.append(name)
+        return 'v%d' % self.columns.index(name)
+
+    def substitute(self, text):
+        return None
+
+    def check(self, code):
+        return code
+
+    def aggregate(self, name, argument, distinct):
+        raise ValueError('Aggregate %s() is not allowed here.' % name)
+
+class GroupContext(object):
+    """Compiles expressions evaluated once per group: GROUP BY expressions become g[i] and aggregates a[i]."""
+    def __init__(self, group_keys, rows):
+        self.group_keys = group_keys
+        self.rows = rows
+        self.aggregates = []
+
+    def resolve(self, name):
+        # Left as a marker for substitute to replace when an enclosing expression is a GROUP BY key.
+        return '\0%s\0' % name
+
+    def check(self, code):
+        if '\0' in code:
+            raise ValueError('Column %s must appear in GROUP BY or in an aggregate.' % code.split('\0')[1])
+        return code
+
+    def substitute(self, text):
+        if text in self.group_keys:
+            return 'g[%d]' % self.group_keys.index(text)
+        return None
+
+    def aggregate(self, name, argument, distinct):
+        code = None if argument is None else ExpressionParser(argument, self.rows).parse()
+        self.aggregates.append((name, code, distinct))
+        return 'a[%d]' % (len(self.aggregates) - 1)
+
+class ExpressionParser(object):
+    """A recursive-descent parser that translates an SQL expression into Python source for a context."""
+    def __init__(self, text, context):
+        self.text = text
+        self.context = context
+        self.tokens = tokenize_expression(text)
+        self.position = 0
+
+    def parse(self):
+        code = self.parse_or()
+        if self.position != len(self.tokens):
+            raise ValueError('Cannot evaluate %r: unexpected %r' % (self.text, self.peek()))
+        return self.context.check(code)
+
+    def parse_list(self):
+        """Parses comma separated expressions, each with an optional [AS] alias or ASC/DESC."""
+        items = []
+        while True:
+            start = self.position
+            code = self.parse_or()
+            end = self.offset(self.position)
+            alias = None
+            descending = False
+            if self.peek_word() == 'as':
+                self.position += 1
+                alias = self.take()[1]
+            elif self.peek_word() in ('asc', 'desc'):
+                descending = self.take()[1].lower() == 'desc'
+            elif self.peek() is not None and self.peek()[0] in ('word', 'quoted') and self.peek()[1][0] != "'":
+                alias = self.take()[1]
+            items.append((self.context.check(code), self.text[self.offset(start):end].strip(), alias, descending))
+            if self.peek_text() != ',':
+                break
+            self.position += 1
+        if self.position != len(self.tokens):
+            raise ValueError('Cannot evaluate %r: unexpected %r' % (self.text, self.peek()))
+        return items
+
+    def parse_order_list(self, columns):
+        """Parses ORDER BY items into (code, column index, descending) triples.
+
+        An item that is just an output column name (or alias) or a 1-based ordinal refers to that
+        column of the result and gets an index instead of code.
+        """
+        references = dict((column.lower(), index) for index, column in enumerate(columns))
+        items = []
+        while True:
+            index = self.get_reference(references, len(columns))
+            code = None
+            if index is None:
+                code = self.context.check(self.parse_or())
+            else:
+                self.position += 1
+            descending = False
+            if self.peek_word() in ('asc', 'desc'):
+                descending = self.take()[1].lower() == 'desc'
+            items.append((code, index, descending))
+            if self.peek_text() != ',':
+                break
+            self.position += 1
+        if self.position != len(self.tokens):
+            raise ValueError('Cannot evaluate %r: unexpected %r' % (self.text, self.peek()))
+        return items
+
+    def get_reference(self, references, count):
+        token = self.peek()
+        following = self.peek(1)
+        if following is not None and following[0] == 'word' and following[1].lower() in ('asc', 'desc'):
+            following = self.peek(2)
+        if token is None or (following is not None and following[1] != ','):
+            return None
+        kind, text, _ = token
+        if kind == 'number' and text.isdigit():
+            if not 1 <= int(text) <= count:
+                raise ValueError('ORDER BY position %s is not in the select list.' % text)
+            return int(text) - 1
+        if kind in ('word', 'quoted') and text[0] != "'":
+            return references.get((text[1:-1] if kind == 'quoted' else text).lower())
+        return None
+
+    def parse_or(self):
+        return self.parse_binary(self.parse_and, 'or', 'or_')
+
+    def parse_and(self):
+        return self.parse_binary(self.parse_not, 'and', 'and_')
+
+    def parse_binary(self, parse_operand, word, function):
+        start = self.position
+        code = parse_operand()
+        while self.peek_word() == word:
+            self.position += 1
+            code = '%s(%s, %s)' % (function, code, parse_operand())
+        return self.substituted(start, code)
+
+    def parse_not(self):
+        if self.peek_word() == 'not':
+            self.position += 1
+            return 'not_(%s)' % self.parse_not()
+        return self.parse_predicate()
+
+    def parse_predicate(self):
+        start = self.position
+        code = self.parse_additive()
+        while True:
+            operator_text = self.peek_text()
+            negated = False
+            if operator_text in comparison_operators:
+                self.position += 1
+                code = '%s(%s, %s)' % (comparison_operators[operator_text], code, self.parse_additive())
+                continue
+            word = self.peek_word()
+            if word == 'is':
+                self.position += 1
+                negated = self.peek_word() == 'not'
+                if negated:
+                    self.position += 1
+                self.expect_word('null')
+                code = '(%s %s None)' % (code, 'is not' if negated else 'is')
+                continue
+            if word == 'not' and self.peek_word(1) in ('in', 'between', 'like'):
+                self.position += 1
+                negated = True
+                word = self.peek_word()
+            if word == 'in':
+                self.position += 1
+                self.expect_text('(')
+                values = [self.parse_or()]
+                while self.peek_text() == ',':
+                    self.position += 1
+                    values.append(self.parse_or())
+                self.expect_text(')')
+                code = 'in_list(%s, (%s,))' % (code, ', '.join(values))
+            elif word == 'between':
+                self.position += 1
+                low = self.parse_additive()
+                self.expect_word('and')
+                code = 'and_(ge(%s, %s), le(%s, %s))' % (code, low, code, self.parse_additive())
+            elif word == 'like':
+                self.position += 1
+                code = 'like(%s, %s)' % (code, self.parse_additive())
+            else:
+                return self.substituted(start, code)
+            if negated:
+                code = 'not_(%s)' % code
+
+    def parse_additive(self):
+        start = self.position
+        code = self.parse_multiplicative()
+        while self.peek_text() in ('+', '-', '||'):
+            function = arithmetic_operators[self.take()[1]]
+            code = '%s(%s, %s)' % (function, code, self.parse_multiplicative())
+        return self.substituted(start, code)
+
+    def parse_multiplicative(self):
+        start = self.position
+        code = self.parse_unary()
+        while self.peek_text() in ('*', '/', '%'):
+            function = arithmetic_operators[self.take()[1]]
+            code = '%s(%s, %s)' % (function, code, self.parse_unary())
+        return self.substituted(start, code)
+
+    def parse_unary(self):
+        if self.peek_text() == '-':
+            self.position += 1
+            return 'neg(%s)' % self.parse_unary()
+        if self.peek_text() == '+':
+            self.position += 1
+        return self.parse_primary()
+
+    def parse_primary(self):
+        start = self.position
+        token = self.take()
+        if token is None:
+            raise ValueError('Cannot evaluate %r: unexpected end' % self.text)
+        kind, text, _ = token
+        if kind == 'number':
+            return repr(float(text) if '.' in text or 'e' in text.lower() else int(text))
+        if kind == 'quoted' and text[0] == "'":
+            return repr(text[1:-1].replace("''", "'"))
+        if text == '(':
+            code = self.parse_or()
+            self.expect_text(')')
+            return self.substituted(start, '(%s)' % code)
+        if kind == 'quoted':
+            return self.substituted(start, self.context.resolve(text[1:-1].lower()))
+        if kind != 'word':
+            raise ValueError('Cannot evaluate %r: unexpected %r' % (self.text, text))
+        word = text.lower()
+        if word in ('null', 'true', 'false'):
+            return {'null': 'None', 'true': 'True', 'false': 'False'}[word]
+        if word == 'case':
+            return self.parse_case()
+        if self.peek_text() != '(':
+            return self.substituted(start, self.context.resolve(word))
+        self.position += 1
+        if word in aggregate_names:
+            distinct = self.peek_word() == 'distinct'
+            if distinct:
+                self.position += 1
+            if self.peek_text() == '*' and word == 'count':
+                self.position += 1
+                argument = None
+            else:
+                argument_start = self.offset(self.position)
+                depth = 0
+                while not (depth == 0 and self.peek_text() == ')'):
+                    token = self.take()
+                    if token is None:
+                        raise ValueError('Cannot evaluate %r: unclosed %s(' % (self.text, word))
+                    depth += {'(': 1, ')': -1}.get(token[1], 0)
+                argument = self.text[argument_start:self.offset(self.position)]
+            self.expect_text(')')
+            return self.substituted(start, self.context.aggregate(word, argument, distinct))
+        if word not in scalar_functions:
+            raise ValueError('Cannot evaluate %r: unknown function %s' % (self.text, word))
+        arguments = []
+        while self.peek_text() != ')':
+            arguments.append(self.parse_or())
+            if self.peek_text() == ',':
+                self.position += 1
+        self.expect_text(')')
+        return self.substituted(start, '%s(%s)' % (scalar_functions[word], ', '.join(arguments)))
+
+    def parse_case(self):
+        branches = []
+        while self.peek_word() == 'when':
+            self.position += 1
+            branches.append(self.parse_or())
+            self.expect_word('then')
+            branches.append(self.parse_or())
+        if self.peek_word() == 'else':
+            self.position += 1
+            branches.append(self.parse_or())
+        self.expect_word('end')
+        return 'case(%s)' % ', '.join(branches)
+
+    def substituted(self, start, code):
+        text = normalize_expression(self.text[self.offset(start):self.offset(self.position)])
+        return self.context.substitute(text) or code
+
+    def offset(self, position):
+        return self.tokens[position][2] if position < len(self.tokens) else len(self.text)
+
+    def peek(self, ahead=0):
+        position = self.position + ahead
+        return self.tokens[position] if position < len(self.tokens) else None
+
+    def peek_text(self):
+        token = self.peek()
+        return None if token is None else token[1]
+
+    def peek_word(self, ahead=0):
+        token = self.peek(ahead)
+        return token[1].lower() if token is not None and token[0] == 'word' else None
+
+    def take(self):
+        token = self.peek()
+        if token is not None:
+            self.position += 1
+        return token
+
+    def expect_text(self, text):
+        if self.peek_text() != text:
+            raise ValueError('Cannot evaluate %r: expected %r' % (self.text, text))
+        self.position += 1
+
+    def expect_word(self, word):
+        if self.peek_word() != word:
+            raise ValueError('Cannot evaluate %r: expected %s' % (self.text, word.upper()))
+        self.position += 1
+
+class Plan(object):
+    """A query compiled for running over record batches; see compile_plan."""
+    def __init__(self, sql):
+        if not isinstance(sql, SQL):
+            sql = SQL.from_string(sql)
+        if not sql._select.value:
+            raise ValueError('Cannot run a query without SELECT.')
+        self.sql = sql
+        self.limit = sql._limit.value or None
+        group_by = sql._group_by.get_value_without_component() if sql._group_by.value else None
+        having = sql._having.get_value_without_component() if sql._having.value else None
+        select = sql._select.get_value_without_component()
+        tokens = tokenize_expression(select)
+        self.distinct = bool(tokens) and tokens[0][1].lower() == 'distinct'
+        if tokens and tokens[0][1].lower() in ('distinct', 'all'):
+            if len(tokens) == 1:
+                raise ValueError('Cannot run a SELECT %s without columns.' % tokens[0][1].upper())
+            select = select[tokens[1][2]:]
+        order_by = sql._order_by.get_value_without_component() if sql._order_by.value else ''
+        self.star = select.strip() == '*'
+        self.aggregated = bool(group_by or having) or has_aggregate(select) or has_aggregate(order_by)
+        self.rows = RowContext()
+        self.where = None
+        if sql._where.value:
+            self.where = ExpressionParser(sql._where.get_value_without_component(), self.rows).parse()
+        if self.aggregated:
+            if self.star:
+                raise ValueError('Cannot SELECT * from an aggregated query.')
+            group_items = ExpressionParser(group_by, self.rows).parse_list() if group_by else []
+            self.group_keys = [code for code, _, _, _ in group_items]
+            self.context = GroupContext([normalize_expression(text) for _, text, _, _ in group_items], self.rows)
+        else:
+            self.context = self.rows
+        self.having = ExpressionParser(having, self.context).parse() if having else None
+        self.columns = []
+        self.select = []
+        if not self.star:
+            for code, text, alias, _ in ExpressionParser(select, self.context).parse_list():
+                self.select.append(code)
+                self.columns.append(alias or text)
+        self.order = []
+        if order_by:
+            self.order = ExpressionParser(order_by, self.context).parse_order_list(self.columns)
+        self._bound = {}
+
+    def execute(self, batches):
+        """Yields the result rows of the query over batches as tuples, in the order of columns."""
+        rows = self.iter_aggregated_rows(batches) if self.aggregated else self.iter_rows(batches)
+        if self.distinct:
+            rows = iter_distinct_rows(rows)
+        if self.order:
+            key = get_sort_key
+            if self.limit is not None:
+                rows = heapq.nsmallest(self.limit, rows, key=key)
+            else:
+                rows = sorted(rows, key=key)
+            return (row for _, row in rows)
+        rows = (row for _, row in rows)
+        if self.limit is not None:
+            rows = itertools.islice(rows, self.limit)
+        return rows
+
+    def iter_rows(self, batches):
+        for batch in batches:
+            evaluate, columns = self.bind(batch)
+            size = len(columns[0]) if columns else len(next(iter(batch.values()), ()))
+            if self.where is not None:
+                mask = evaluate['where'](size, *columns)
+                columns = [list(itertools.compress(column, mask)) for column in columns]
+                size = sum(1 for selected in mask if selected)
+            if self.star:
+                self.columns = list(batch)
+                outputs = [batch[name] for name in batch]
+                if self.where is not None:
+                    outputs = [list(itertools.compress(column, mask)) for column in outputs]
+            else:
+                outputs = [function(size, *columns) for function in evaluate['select']]
+            keys = self.get_order_columns(outputs, [function(size, *columns) for function in evaluate['order']], size)
+            for key, row in zip(keys, zip(*outputs) if outputs else [()] * size):
+                yield key, row
+
+    def iter_aggregated_rows(self, batches):
+        groups = OrderedDict()
+        aggregates = self.context.aggregates
+        for batch in batches:
+            evaluate, columns = self.bind(batch)
+            size = len(columns[0]) if columns else len(next(iter(batch.values()), ()))
+            if self.where is not None:
+                mask = evaluate['where'](size, *columns)
+                columns = [list(itertools.compress(column, mask)) for column in columns]
+                size = sum(1 for selected in mask if selected)
+            keys = zip(*[function(size, *columns) for function in evaluate['group']]) if self.group_keys else [()] * size
+            arguments = [function(size, *columns) if function is not None else [0] * size for function in evaluate['aggregate']]
+            for index, key in enumerate(keys):
+                states = groups.get(key)
+                if states is None:
+                    states = groups[key] = make_aggregate_states(aggregates)
+                for state, argument in zip(states, arguments):
+                    state.add(argument[index])
+        if not groups and not self.group_keys:
+            groups[()] = make_aggregate_states(aggregates)
+        having = self.compile_group_function(self.having)
+        select = [self.compile_group_function(code) for code in self.select]
+        order = [self.compile_group_function(code) for code, _, _ in self.order]
+        for key, states in groups.items():
+            results = [state.result() for state in states]
+            if having is not None and not having(key, results):
+                continue
+            row = tuple(function(key, results) for function in select)
+            values = [function(key, results) if function is not None else None for function in order]
+            yield self.get_order_key(row, values), row
+
+    def get_order_columns(self, outputs, order_values, size):
+        if not self.order:
+            return itertools.repeat(None, size)
+        columns = []
+        evaluated = iter(order_values)
+        for code, index, _ in self.order:
+            columns.append(outputs[index] if code is None else next(evaluated))
+        return (tuple(make_sort_key(value, descending) for value, (_, _, descending) in zip(row, self.order))
+                for row in zip(*columns))
+
+    def get_order_key(self, row, values):
+        if not self.order:
+            return None
+        return tuple(make_sort_key(row[index] if code is None else value, descending)
+                     for value, (code, index, descending) in zip(values, self.order))
+
+    def bind(self, batch):
+        """Compiles the row-level expressions for the columns of batch and returns them with the
+        batch's column lists in the order the expressions use them."""
+        names = tuple(batch)
+        bound = self._bound.get(names)
+        if bound is None:
+            lookup = dict((name.lower(), name) for name in names)
+            keys = [resolve_column(lookup, column) for column in self.rows.columns]
+            arity = len(keys)
+            evaluate = {
+                'where': compile_row_function(self.where, arity),
+                'select': [] if self.aggregated or self.star else [compile_row_function(code, arity) for code in self.select],
+                'order': [] if self.aggregated else [compile_row_function(code, arity) for code, _, _ in self.order if code is not None],
+                'group': [compile_row_function(code, arity) for code in self.group_keys] if self.aggregated else [],
+                'aggregate': [compile_row_function(code, arity) if code is not None else None
+                              for _, code, _ in self.context.aggregates] if self.aggregated else [],
+            }
+            bound = self._bound[names] = (evaluate, keys)
+        evaluate, keys = bound
+        return evaluate, [batch[key] for key in keys]
+
+    def compile_group_function(self, code):
+        if code is None:
+            return None
+        namespace = dict(runtime)
+        exec('def function(g, a): return %s' % code, namespace)
+        return namespace['function']
+
+def compile_plan(sql):
+    """Compiles sql (an SQL object or a query string) into a Plan."""
+    return Plan(sql)
+
+def execute(sql, batches):
+    """Returns the result rows of sql over batches as a list of tuples."""
+    return list(compile_plan(sql).execute(batches))
+
+def iter_record_batches(records, batch_size=1024):
+    """Groups an iterable of dicts into record batches; the first record decides the columns."""
+    iterator = iter(records)
+    while True:
+        records = list(itertools.islice(iterator, batch_size))
+        if not records:
+            return
+        names = list(records[0])
+        yield OrderedDict((name, [record.get(name) for record in records]) for name in names)
+
+def iter_csv_batches(source, batch_size=1024, convert=True):
+    """Reads a CSV file (a path or a file object) with a header row as record batches.
+
+    With convert set, empty fields become None and fields that look like numbers become int or float.
+    """
+    if not hasattr(source, 'read'):
+        fileobj = open(source, 'rb') if sys.version_info[0] == 2 else io.open(source, newline='')
+    else:
+        fileobj = source
+    try:
+        reader = csv.reader(fileobj)
+        names = next(reader, None)
+        if names is None:
+            return
+        while True:
+            rows = list(itertools.islice(reader, batch_size))
+            if not rows:
+                return
+            columns = [list(column) for column in zip(*rows)]
+            if convert:
+                columns = [[convert_value(value) for value in column] for column in columns]
+            yield OrderedDict(zip(names, columns))
+    finally:
+        if fileobj is not source:
+            fileobj.close()
+
+def convert_value(text):
+    if text == '':
+        return None
+    try:
+        return int(text)
+    except ValueError:
+        try:
+            return float(text)
+        except ValueError:
+            return text
+
+def tokenize_expression(text):
+    """Returns (kind, text, offset) tokens of an expression, skipping whitespace."""
+    tokens = []
+    # Looked up on the module each time, since set_backslash_escapes replaces the pattern.
+    for match in spyql.expression_token_pattern.finditer(text):
+        kind = match.lastgroup
+        if kind == 'space':
+            continue
+        token = match.group()
+        if kind == 'other' and tokens and tokens[-1][0] == 'other' and tokens[-1][2] + 1 == match.start() \
+                and tokens[-1][1] + token in multi_character_operators:
+            tokens[-1] = ('other', tokens[-1][1] + token, tokens[-1][2])
+            continue
+        tokens.append((kind, token, match.start()))
+    return tokens
+
+def has_aggregate(text):
+    tokens = tokenize_expression(text)
+    return any(kind == 'word' and token.lower() in aggregate_names and index + 1 < len(tokens) and tokens[index + 1][1] == '('
+               for index, (kind, token, _) in enumerate(tokens))
+
+def resolve_column(lookup, column):
+    key = lookup.get(column)
+    if key is None and '.' in column:
+        key = lookup.get(column.rsplit('.', 1)[1])
+    if key is None:
+        raise ValueError('Unknown column %s' % column)
+    return key
+
+def compile_row_function(code, arity):
+    """Compiles code over the variables v0..v<arity-1> into a function of (size, column lists) that
+    returns the list of its values, one per row."""
+    if code is None:
+        return None
+    variables = ', '.join('v%d' % index for index in range(arity))
+    columns = ', '.join('c%d' % index for index in range(arity))
+    if not arity:
+        source = 'def function(size): return [%s for _ in range(size)]' % code
+    elif arity == 1:
+        source = 'def function(size, c0): return [%s for v0 in c0]' % code
+    else:
+        source = 'def function(size, %s): return [%s for %s in zip(%s)]' % (columns, code, variables, columns)
+    namespace = dict(runtime)
+    exec(source, namespace)
+    return namespace['function']
+
+def iter_distinct_rows(rows):
+    """Drops the (sort key, row) pairs whose row was already seen."""
+    seen = set()
+    for key, row in rows:
+        if row not in seen:
+            seen.add(row)
+            yield key, row
+
+def make_aggregate_states(aggregates):
+    states = []
+    for name, _, distinct in aggregates:
+        state = aggregate_classes[name]()
+        states.append(Distinct(state) if distinct else state)
+    return states
+
+def make_sort_key(value, descending):
+    # NULLs sort first ascending and last descending.
+    key = (value is not None, value)
+    return Descending(key) if descending else key
+
+def get_sort_key(item):
+    return item[0]
@@ -0,0 +1,266 @@
+"""Runs spyql queries through a bounded pool of DB-API connections.
+
+This module is optional: spyql itself only builds query strings.  Any DB-API 2.0 driver can be
+plugged in through a connect function; sqlite3 from the standard library is the reference backend
+(see sqlite_pool).
+"""
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from spyql import SQL, SQLTemplate
+
+# Whitespace outside of quoted literals and identifiers, which normalize_statement collapses.
+statement_whitespace_pattern = re.compile(r"""'(?:[^'\\]|\\.|'')*'?|"(?:[^"\\]|\\.)*"?|`[^`]*`?|(?P<space>\s+)""")
+
+class StatementCache(object):
+    """A per-connection LRU of cursors keyed on normalized statement text.
+
+    The key is only used for lookups: drivers are always given the caller's statement, since
+    normalize_statement does not know about comments.  Re-executing the same text on the same cursor lets the driver reuse its prepared statement.
+    Drivers whose cursors have a prepare method get it called once per statement.  Evicted cursors
+    are closed.
+    """
+    def __init__(self, connection, max_statements=128):
+        self.connection = connection
+        self.max_statements = max_statements
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._cursors = OrderedDict()
+
+    def get_cursor(self, key, statement=None):
+        """Returns the cursor cached under key, the normalized form of statement."""
+        cursor = self._cursors.pop(key, None)
+        if cursor is None:
+            self.misses += 1
+            while self._cursors and len(self._cursors) >= self.max_statements:
+                _, evicted = self._cursors.popitem(last=False)
+                evicted.close()
+                self.evictions += 1
+            cursor = self.connection.cursor()
+            if hasattr(cursor, 'prepare'):
+                cursor.prepare(key if statement is None else statement)
+        else:
+            self.hits += 1
+        self._cursors[key] = cursor
+        return cursor
+
+    def discard(self, statement):
+        cursor = self._cursors.pop(statement, None)
+        if cursor is not None:
+            cursor.close()
+
+    def clear(self):
+        for cursor in self._cursors.values():
+            cursor.close()
+        self._cursors.clear()
+
+    def __len__(self):
+        return len(self._cursors)
+
+class PooledConnection(object):
+    """A DB-API connection checked out of a ConnectionPool, together with its StatementCache."""
+    def __init__(self, connection, max_statements=128):
+        self.connection = connection
+        self.statements = StatementCache(connection, max_statements)
+
+    def execute(self, statement, params=()):
+        cursor = self.statements.get_cursor(normalize_statement(statement), statement)
+        cursor.execute(statement, params)
+        return cursor
+
+    def executemany(self, statement, param_sets):
+        cursor = self.statements.get_cursor(normalize_statement(statement), statement)
+        cursor.executemany(statement, param_sets)
+        return cursor
+
+    def commit(self):
+        self.connection.commit()
+
+    def rollback(self):
+        self.connection.rollback()
+
+    def close(self):
+        self.statements.clear()
+        self.connection.close()
+
+class ConnectionPool(object):
+    """A thread-safe pool of at most max_connections connections made by calling connect().
+
+    Connections are opened on demand and reused; acquire() blocks while all of them are checked out,
+    and raises ValueError once timeout seconds have passed.  paramstyle is the driver's DB-API
+    paramstyle, used when binding SQLTemplate parameters.
+    """
+    def __init__(self, connect, max_connections=4, max_statements=128, timeout=None, paramstyle='qmark'):
+        if max_connections < 1:
+            raise ValueError('A connection pool needs at least 1 connection.')
+        self.connect = connect
+        self.max_connections = max_connections
+        self.max_statements = max_statements
+        self.timeout = timeout
+        self.paramstyle = paramstyle
+        self.size = 0
+        self._idle = []
+        self._closed = False
+        self._condition = threading.Condition()
+
+    def acquire(self, timeout=None):
+        if timeout is None:
+            timeout = self.timeout
+        deadline = None if timeout is None else time.time() + timeout
+        with self._condition:
+            while True:
+                if self._closed:
+                    raise ValueError('Cannot acquire a connection from a closed pool.')
+                if self._idle:
+                    return self._idle.pop()
+                if self.size < self.max_connections:
+                    self.size += 1
+                    break
+                if deadline is None:
+                    self._condition.wait()
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise ValueError('Timed out waiting for one of %d connections.' % self.max_connections)
+                    self._condition.wait(remaining)
+        try:
+            return PooledConnection(self.connect(), self.max_statements)
+        except Exception:
+            with self._condition:
+                self.size -= 1
+                self._condition.notify()
+            raise
+
+    def release(self, connection):
+        with self._condition:
+            if not self._closed:
+                self._idle.append(connection)
+                self._condition.notify()
+                return
+            self.size -= 1
+        connection.close()
+
+    def discard(self, connection):
+        """Closes a connection that is no longer usable instead of returning it to the pool."""
+        with self._condition:
+            self.size -= 1
+            self._condition.notify()
+        try:
+            connection.close()
+        except Exception:
+            pass
+
+    @contextmanager
+    def connection(self, timeout=None):
+        """Checks out a connection for the duration of a with block, rolling back if the block raises."""
+        connection = self.acquire(timeout)
+        try:
+            yield connection
+        except BaseException:
+            try:
+                connection.rollback()
+            except Exception:
+                self.discard(connection)
+                raise
+            self.release(connection)
+            raise
+        self.release(connection)
+
+    def close(self):
+        """Closes the idle connections; connections still checked out are closed when released."""
+        with self._condition:
+            self._closed = True
+            idle, self._idle = self._idle, []
+            self.size -= len(idle)
+            self._condition.notify_all()
+        for connection in idle:
+            connection.close()
+
+class Executor(object):
+    """Runs SQL objects, SQLTemplates and plain strings on a ConnectionPool.
+
+    Results are streamed with fetchmany in batches of batch_size rows.  A result stream keeps its
+    connection checked out until it is exhausted or closed.
+    """
+    def __init__(self, pool, batch_size=500):
+        self.pool = pool
+        self.batch_size = batch_size
+
+    def iter_batches(self, query, params=None, batch_size=None):
+        """Yields the rows of query as lists of at most batch_size rows."""
+        statement, params = self.get_statement(query, params)
+        batch_size = batch_size or self.batch_size
+        with self.pool.connection() as connection:
+            cursor = connection.execute(statement, params)
+            if cursor.description is None:
+                return
+            exhausted = False
+            try:
+                while True:
+                    rows = cursor.fetchmany(batch_size)
+                    if not rows:
+                        exhausted = True
+                        break
+                    yield rows
+            finally:
+                if not exhausted:
+                    # The cursor is still mid-result; drop it rather than hand it out again.
+                    connection.statements.discard(normalize_statement(statement))
+
+    def execute(self, query, params=None, batch_size=None):
+        """Yields the rows of query one at a time, fetching them in batches."""
+        for rows in self.iter_batches(query, params, batch_size):
+            for row in rows:
+                yield row
+
+    def run(self, query, params=None):
+        """Runs a statement that returns no rows, commits, and returns its rowcount."""
+        statement, params = self.get_statement(query, params)
+        with self.pool.connection() as connection:
+            rowcount = connection.execute(statement, params).rowcount
+            connection.commit()
+        return rowcount
+
+    def run_many(self, query, param_sets):
+        """Runs a statement once per entry of param_sets with executemany and commits."""
+        if isinstance(query, SQLTemplate):
+            statement, param_sets = query.bind_many(param_sets, self.pool.paramstyle)
+        else:
+            statement, _ = self.get_statement(query, None)
+        with self.pool.connection() as connection:
+            rowcount = connection.executemany(statement, param_sets).rowcount
+            connection.commit()
+        return rowcount
+
+    def get_statement(self, query, params):
+        if isinstance(query, SQLTemplate):
+            return query.bind_params(params or {}, self.pool.paramstyle)
+        if isinstance(query, SQL):
+            query = query.as_string
+        elif not isinstance(query, str):
+            raise ValueError('Cannot execute %s' % type(query).__name__)
+        return query, () if params is None else params
+
+def sqlite_pool(database, max_connections=4, max_statements=128, timeout=None, **kwargs):
+    """Returns a ConnectionPool of sqlite3 connections to database.
+
+    Every ':memory:' connection is a separate database, so share a file (or a URI with
+    cache=shared) between pooled connections.
+    """
+    def connect():
+        return sqlite3.connect(database, check_same_thread=False, **kwargs)
+    return ConnectionPool(connect, max_connections, max_statements, timeout, sqlite3.paramstyle)
+
+def normalize_statement(statement):
+    """Collapses whitespace outside of quoted literals and drops a trailing ';'."""
+    def replace(match):
+        return ' ' if match.group('space') else match.group(0)
+    statement = statement_whitespace_pattern.sub(replace, statement).strip()
+    while statement.endswith(';'):
+        statement = statement[:-1].rstrip()
+    return statement
@@ -25,6 +25,167 @@ class TestSql(unittest.TestCase):
         self.assertEqual(sql.as_string, 'SELECT a, c, k FROM b, d, (select k from ztab left outer join ytab using (date)) tabk WHERE a > c and k in (select k from ytab where k > 5)')
 
 
+    def test__sql__parse_cache(self):
+        from spyql import SQL, SQLParseCache, SQLWhere
+        cache = SQLParseCache(max_entries=2, max_bytes=64)
+        SQL.parse_cache = cache
+        try:
+            sql = SQL.from_string('SELECT a FROM b')
+            sql += SQLWhere('a > 1')
+            self.assertEqual(SQL.from_string('SELECT a FROM b').as_string, 'SELECT a FROM b')
+            self.assertEqual((cache.hits, cache.misses, cache.evictions), (1, 1, 0))
+
+            SQL.from_string('SELECT c FROM d')
+            SQL.from_string('SELECT a FROM b')
+            SQL.from_string('SELECT e FROM f')
+            self.assertEqual((cache.hits, cache.misses, cache.evictions), (2, 3, 1))
+            self.assertEqual(len(cache), 2)
+
+            SQL.from_string('SELECT %s FROM g' % ('x' * 40))
+            self.assertEqual((cache.evictions, len(cache)), (3, 1))
+            self.assertTrue(cache.size <= cache.max_bytes)
+        finally:
+            SQL.parse_cache = None
+
+    def test__sql__lazy_parse(self):
+        from spyql import SQL, SQLWhere, FrozenSQL
+        statements = ['SELECT a, b FROM c WHERE d = 1 GROUP BY a HAVING count(*) > 1 ORDER BY b limit 5',
+                      'select a from b where c in (select d from e where f)',
+                      'FROM a\n\tWHERE b = "SELECT ; FROM"']
+        for statement in statements:
+            self.assertEqual(SQL.from_string(statement, lazy=True).as_string, SQL.from_string(statement).as_string)
+            self.assertEqual(FrozenSQL.from_string(statement, lazy=True).as_string, SQL.from_string(statement).as_string)
+
+        sql = SQL.from_string(statements[0], lazy=True)
+        self.assertEqual(sql._components[0], (7, 11))
+        self.assertEqual(sql._limit.value, 5)
+        self.assertEqual(sql._where.value, 'd = 1')
+        self.assertEqual(sql._components[2].__class__, SQLWhere)
+        self.assertEqual(sql._components[0], (7, 11))
+        sql += SQLWhere('e = 2')
+        self.assertEqual(sql.as_string, 'SELECT a, b FROM c WHERE d = 1 and e = 2 GROUP BY a HAVING count(*) > 1 ORDER BY b LIMIT 5')
+        self.assertEqual(sql.copy().as_string, sql.as_string)
+        self.assertRaises(ValueError, SQL.from_string, 'WHERE a', lazy=True)
+
+    def test__sql__from_buffer(self):
+        import io
+        import os
+        import tempfile
+        from spyql import SQL, SQLWhere
+        statement = 'select a,\n\tb from t where x in (1, 2,\n 3) order by "c" limit 4;\n'
+        expected = SQL.from_string(statement).as_string
+        descriptor, path = tempfile.mkstemp()
+        try:
+            with os.fdopen(descriptor, 'wb') as fileobj:
+                fileobj.write(statement.encode('ascii'))
+            for sql in (SQL.from_file(path), SQL.from_buffer(bytearray(statement.encode('ascii')))):
+                self.assertEqual(sql.as_string, expected)
+                self.assertEqual(sql._components[2], (26, 41))
+                sink = io.BytesIO()
+                sql.write_to(sink)
+                self.assertEqual(sink.getvalue(), expected.encode('ascii'))
+
+                sql += SQLWhere('y')
+                sink = io.BytesIO()
+                sql.write_to(sink)
+                self.assertEqual(sink.getvalue(), sql.as_string.encode('ascii'))
+                self.assertEqual(sql._components[5], (51, 54))
+        finally:
+            os.remove(path)
+
+    def test__sql__iter_render(self):
+        import io
+        from spyql import SQL, FrozenSQL, SQLWhere, SQLSelect, SQLLimit
+        sql = SQL.from_string('select a from b where c > 1')
+        for i in range(50):
+            sql += SQLWhere('d%d = %d' % (i, i))
+        sql += SQLSelect('Select e')
+        self.assertTrue(len(list(sql.iter_render())) > 100)
+        queries = [sql, sql.freeze() + SQLWhere('f'), SQL.from_string('select a from b limit 3', lazy=True),
+                   SQL.from_buffer(b'select a,\n\tb from c order by d'), SQL('Select a from (select b)', 'b') + SQLLimit(5),
+                   FrozenSQL.from_string('select a from b') + SQLWhere('WHERE x') + SQLWhere('y')]
+        for query in queries:
+            expected = query.as_string
+            for fresh in (query.copy(), query):
+                fragments = list(fresh.iter_render())
+                self.assertEqual(''.join(fragments), expected)
+            sink = io.BytesIO()
+            query.copy().write_to(sink)
+            self.assertEqual(sink.getvalue(), expected.encode('utf-8'))
+            written = []
+            query.copy().write_to(type('Sink', (object,), {'write': lambda self, text: written.append(text)})(), encoding=None)
+            self.assertEqual(''.join(written), expected)
+
+    def test__sql__compact_layout(self):
+        from spyql import SQL, SQLWhere
+        first = SQL.from_string('SELECT a FROM b')
+        second = SQL.from_string('SELECT c FROM d')
+        self.assertFalse(hasattr(first, '__dict__') or hasattr(first._select, '__dict__'))
+        self.assertFalse(hasattr(first.freeze(), '__dict__') or hasattr(first.freeze()._select, '__dict__'))
+        self.assertEqual(first._components[2:], (None,) * 5)
+        self.assertTrue(first.freeze()._where is second.freeze()._where)
+        self.assertFalse(first._where is second._where)
+
+        # Changing an absent clause in place only affects its own query.
+        changed = SQL.from_string('SELECT a FROM b')
+        changed._where.value = 'x > 1'
+        untouched = SQL.from_string('select c from d')
+        self.assertEqual(untouched._where.value, None)
+        self.assertEqual((untouched.tree().as_string, changed.as_string), ('SELECT c FROM d', 'SELECT a FROM b WHERE x > 1'))
+
+        first._where += 'a > 1'
+        second += SQLWhere('c > 2')
+        self.assertEqual(first.as_string, 'SELECT a FROM b WHERE a > 1')
+        self.assertEqual(second.as_string, 'SELECT c FROM d WHERE c > 2')
+        self.assertEqual(SQL.from_string('SELECT e FROM f')._where.value, None)
+
+    def test__sql__combine(self):
+        from spyql import SQL, FrozenSQL, SQLWhere, SQLLimit, SQLFrom, SQLSelect
+        first = SQL.from_string('SELECT a FROM b')
+        queries = [first, 'select c from d where c > 1', SQLWhere('a > c'), SQLFrom('inner join e using (f)'), SQLLimit(10)]
+        expected = 'SELECT a, c FROM b, d inner join e using (f) WHERE c > 1 and a > c LIMIT 10'
+        self.assertEqual(SQL.combine(iter(queries)).as_string, expected)
+        self.assertEqual(FrozenSQL.combine(queries).as_string, expected)
+        self.assertEqual(first.as_string, 'SELECT a FROM b')
+
+        looped = SQL.from_string('SELECT a FROM b')
+        for query in queries[1:]:
+            if isinstance(query, str):
+                query = SQL.from_string(query)
+            looped += query
+        self.assertEqual(looped.as_string, expected)
+
+        with self.assertRaises(ValueError):
+            SQL.combine([first, SQLLimit(1), SQLLimit(2)])
+        with self.assertRaises(ValueError):
+            SQL.combine([SQLWhere('a > 1')])
+
+        self.assertEqual(SQLSelect.combine(x for x in ['SELECT a', SQLSelect('b'), '', 'c']).value, 'SELECT a, b, c')
+
+    def test__frozen_sql__add(self):
+        from spyql import SQL, FrozenSQL, SQLWhere, SQLLimit, FrozenSQLFrom
+        base = FrozenSQL.from_string('SELECT a FROM b WHERE a > 1')
+        variant = base + SQLWhere('a < 5') + SQL.from_string('select c from d inner join e using (f) limit 3')
+        self.assertEqual(base.as_string, 'SELECT a FROM b WHERE a > 1')
+        self.assertEqual(variant.as_string, 'SELECT a, c FROM b, d inner join e using (f) WHERE a > 1 and a < 5 LIMIT 3')
+        self.assertTrue(isinstance(variant, FrozenSQL))
+        self.assertTrue(variant._group_by is base._group_by)
+        with self.assertRaises(ValueError):
+            variant + SQLLimit(4)
+        with self.assertRaises(AttributeError):
+            base._where = SQLWhere('x')
+
+        sql = SQL.from_string('SELECT a FROM b')
+        frozen = sql.freeze()
+        sql += SQLWhere('a > 1')
+        self.assertEqual(frozen.as_string, 'SELECT a FROM b')
+
+        sql_from = FrozenSQLFrom('FROM t0')
+        for i in range(1, 5000):
+            sql_from += 'FROM t%d' % i
+        self.assertEqual(sql_from.as_string, 'FROM ' + ', '.join('t%d' % i for i in range(5000)))
+        self.assertEqual((FrozenSQLFrom('a') + (FrozenSQLFrom('FROM b') + 'c')).value, 'a, b, c')
+
     def test__sql_select__init(self):
         from spyql import SQLSelect
         must_receive_string_as_input(self, SQLSelect)
@@ -46,6 +207,21 @@ class TestSql(unittest.TestCase):
         self.assertEqual(sql_select.value, 'SELECT test1, test2, test3, test4')
 
 
+    def test__sql_component__deferred_join(self):
+        from spyql import SQLWhere
+        sql_where = SQLWhere('WHERE a = 0')
+        for i in range(1, 1000):
+            sql_where += 'where a = %d' % i
+        self.assertEqual(len(sql_where._pieces), 1999)
+        expected = 'WHERE ' + ' and '.join('a = %d' % i for i in range(1000))
+        self.assertEqual(sql_where.value, expected)
+        self.assertEqual(sql_where._pieces, expected)
+
+        copied = sql_where.copy()
+        copied += 'b = 1'
+        self.assertEqual(sql_where.as_string, expected)
+        self.assertEqual(copied.as_string, expected + ' and b = 1')
+
     def test__sql_from__init(self):
         from spyql import SQLFrom
         must_receive_string_as_input(self, SQLFrom)
@@ -179,7 +355,7 @@ class TestSql(unittest.TestCase):
         self.assertEqual(SQLLimit(5).as_string, 'LIMIT 5')
 
     def test__sql_limit__add(self):
-        from spyql import SQLLimit
+        from spyql import SQL, SQLLimit
 
         sql_limit_by = SQLLimit('')
         self.assertEqual(sql_limit_by.value, None)
@@ -192,6 +368,14 @@ class TestSql(unittest.TestCase):
 
         with self.assertRaises(ValueError):
             sql_limit_by += SQLLimit(60)
+        self.assertEqual(sql_limit_by.value, 50)
+        self.assertEqual(str(sql_limit_by), 'LIMIT 50')
+
+        sql = SQL.from_string('select a from b limit 3')
+        with self.assertRaises(ValueError):
+            sql += SQL.from_string('select c from d limit 4')
+        self.assertEqual(sql._limit.value, 3)
+        self.assertTrue(sql.as_string.endswith(' LIMIT 3'))
 
 
     def test__sql_component__init(self):
@@ -210,7 +394,7 @@ class TestSql(unittest.TestCase):
 
 
     def test__tokenize_sql_component(self):
-        from spyql import tokenize_sql_component
+        from spyql import set_backslash_escapes, tokenize_sql_component
         q0 = tokenize_sql_component('')
         q1 = tokenize_sql_component('SELECT s1, s2 FROM f1')
         q2 = tokenize_sql_component('SELECT s1, s2 FROM f1 as ff1, f2 as ff2 WHERE s1=s2 and s2 = s3 GROUP BY date ORDER BY thing LIMIT 1')
@@ -225,6 +409,19 @@ class TestSql(unittest.TestCase):
         self.assertEqual(q4, ['sub.*', '( SELECT * FROM tutorial.sf_crime_incidents_2014_01 WHERE day_of_week = "Friday" ) sub INNER JOIN calls c', 'sub.resolution = "NONE"', '', '', 'pickles', ''])
         self.assertEqual(qnonsense, ['', '', '', '', '', '', ''])
 
+        # A backslash is an ordinary character in standard SQL, unless a dialect asks for backslash escapes.
+        self.assertEqual(tokenize_sql_component(r"select a from t where p = 'C:\' order by a"), ['a', 't', r"p = 'C:\'", '', '', 'a', ''])
+        set_backslash_escapes(True)
+        try:
+            self.assertEqual(tokenize_sql_component(r"select a from t where p = 'it\'s' order by a"), ['a', 't', r"p = 'it\'s'", '', '', 'a', ''])
+        finally:
+            set_backslash_escapes(False)
+
+        # Only trailing semicolons are dropped; one inside a literal or an identifier is part of the statement.
+        self.assertEqual(tokenize_sql_component('SELECT a FROM b;; \n'), ['a', 'b', '', '', '', '', ''])
+        self.assertEqual(tokenize_sql_component("SELECT a FROM b WHERE c = 'x;y';"), ['a', 'b', "c = 'x;y'", '', '', '', ''])
+        self.assertEqual(tokenize_sql_component('SELECT "a;b" FROM c'), ['"a;b"', 'c', '', '', '', '', ''])
+
     def test__tokenizing_multiline_statement(self):
         from spyql import tokenize_sql_component
         multiline_statement = """
@@ -236,6 +433,367 @@ class TestSql(unittest.TestCase):
         q = tokenize_sql_component(multiline_statement)
         self.assertEqual(q, ['field1, field2', 'table1', "field1 IREGEXP '([0-9] ){15}' or field1 IREGEXP '^.*special information .*  [0-9].*' or '^.*also special info .*  [0-9].*'         and specific > '2018-01-01'", '', '', '', ''])
 
+    def test__tokenize_sql_offsets(self):
+        from spyql import tokenize_sql_offsets
+        statement = 'SELECT a, (select b from c) FROM t WHERE s = \'x from y\' and "(" = u LIMIT 3;'
+        offsets = tokenize_sql_offsets(statement)
+        self.assertEqual([offset and statement[offset[0]:offset[1]] for offset in offsets], ['a, (select b from c)', 't', 's = \'x from y\' and "(" = u', None, None, None, '3'])
+        self.assertEqual(tokenize_sql_offsets('select a from b union select c from d')[:2], [(7, 8), (14, 37)])
+        self.assertEqual(tokenize_sql_offsets('SELECT a GROUP   BY b'), [(7, 8), None, None, (20, 21), None, None, None])
+
+    def test__sql_template(self):
+        from spyql import SQL, SQLTemplate
+        template = SQLTemplate("select a::text, b from t where a = :a and b in :bs and c = ':literal' and d > :a order by :sort limit 5")
+        self.assertEqual(template.placeholders, {'SELECT': [], 'FROM': [], 'WHERE': ['a', 'bs', 'a'], 'ORDER BY': ['sort'], 'LIMIT': []})
+        self.assertEqual(template.names, ['a', 'bs', 'sort'])
+        self.assertEqual(template.bind(a="it's", bs=[1, 2.5, None], sort=True),
+                         "SELECT a::text, b FROM t WHERE a = 'it''s' and b in (1, 2.5, NULL) and c = ':literal' and d > 'it''s' ORDER BY TRUE LIMIT 5")
+        self.assertEqual(template.bind_params({'a': 1, 'bs': (2, 3), 'sort': 'b'}),
+                         ("SELECT a::text, b FROM t WHERE a = ? and b in (?, ?) and c = ':literal' and d > ? ORDER BY ? LIMIT 5", [1, 2, 3, 1, 'b']))
+        self.assertEqual(template.bind_params({'a': 1, 'bs': [2], 'sort': 'b'}, 'numeric'),
+                         ("SELECT a::text, b FROM t WHERE a = :1 and b in (:2) and c = ':literal' and d > :3 ORDER BY :4 LIMIT 5", [1, 2, 1, 'b']))
+        self.assertEqual(template.bind_params({'a': 1, 'bs': (2, 3), 'sort': 'b'}, 'pyformat'),
+                         ("SELECT a::text, b FROM t WHERE a = %(a)s and b in (%(bs__1)s, %(bs__2)s) and c = ':literal' and d > %(a)s ORDER BY %(sort)s LIMIT 5",
+                          {'a': 1, 'bs__1': 2, 'bs__2': 3, 'sort': 'b'}))
+        self.assertEqual(template.bind_params({'a': 1, 'bs': 2, 'sort': 'b'})[1], [1, 2, 1, 'b'])
+        self.assertEqual(template.get_statement('numeric'), "SELECT a::text, b FROM t WHERE a = :1 and b in :2 and c = ':literal' and d > :3 ORDER BY :4 LIMIT 5")
+        with self.assertRaises(ValueError):
+            template.bind(a=1)
+        self.assertEqual(SQLTemplate(r"select a from t where p = 'C:\' and q = :q").bind(q=1), r"SELECT a FROM t WHERE p = 'C:\' and q = 1")
+        self.assertRaises(ValueError, template.bind, a=1, bs=[], sort='b')
+        self.assertRaises(ValueError, template.bind_params, {'a': 1, 'bs': (), 'sort': 'b'})
+        self.assertRaises(ValueError, template.bind_params, {'a': 1, 'bs': set(), 'sort': 'b'}, 'named')
+        # A trailing backslash would escape the closing quote in MySQL (see set_backslash_escapes).
+        self.assertRaises(ValueError, SQLTemplate('select a from t where c = :c and d = 1 order by a').bind, c='x\\')
+        self.assertEqual(SQLTemplate('select a from t where c = :c').bind_params({'c': 'x\\'}), ('SELECT a FROM t WHERE c = ?', ['x\\']))
+
+        template = SQLTemplate(SQL.from_string('SELECT a FROM t WHERE a = :a'))
+        self.assertEqual(template.bind_many([{'a': 1}, {'a': 2}]), ['SELECT a FROM t WHERE a = 1', 'SELECT a FROM t WHERE a = 2'])
+        self.assertEqual(template.bind_many([{'a': 1}, {'a': 2}], 'named'), ('SELECT a FROM t WHERE a = :a', [{'a': 1}, {'a': 2}]))
+        template = SQLTemplate('SELECT a FROM t WHERE a in :a')
+        self.assertEqual(template.bind_many([{'a': [1, 2]}, {'a': (3, 4)}]), ['SELECT a FROM t WHERE a in (1, 2)', 'SELECT a FROM t WHERE a in (3, 4)'])
+        self.assertEqual(template.bind_many([{'a': [1, 2]}, {'a': (3, 4)}], 'qmark'), ('SELECT a FROM t WHERE a in (?, ?)', [[1, 2], [3, 4]]))
+        self.assertRaises(ValueError, template.bind_many, [{'a': [1]}, {'a': [2, 3]}], 'qmark')
+
+    def test__sql__fingerprint(self):
+        from spyql import SQL, SQLWhere
+        first = SQL.from_string("select a,  b from t where x = 5 and y in (1, 2,3) and z = 'it''s' and w > 1.5e3 and \"Col 1\" = 'x' limit 10")
+        second = SQL.from_string("SELECT a, b FROM t\nWHERE x = 7 AND y IN (4) and z = 'q' AND w > .2 and \"Col 1\" = 'y' LIMIT 100")
+        self.assertEqual(first.fingerprint().text, 'SELECT a, b FROM t WHERE x = ? AND y IN (?) AND z = ? AND w > ? AND "Col 1" = ? LIMIT ?')
+        self.assertEqual(first.fingerprint(), second.fingerprint())
+        self.assertTrue(0 <= first.fingerprint().hash < 2 ** 64)
+        self.assertTrue(first.fingerprint() is first.fingerprint())
+
+        first += SQLWhere('v = 1')
+        self.assertEqual(first.fingerprint().text, 'SELECT a, b FROM t WHERE x = ? AND y IN (?) AND z = ? AND w > ? AND "Col 1" = ? AND v = ? LIMIT ?')
+        self.assertNotEqual(first.fingerprint().hash, second.fingerprint().hash)
+
+    def test__sql__render_cache(self):
+        from spyql import SQL, SQLWhere, SQLLimit
+        sql = SQL.from_string('SELECT a FROM b WHERE c > 1 LIMIT 5')
+        version = sql.version
+        self.assertTrue(sql.as_string is sql.as_string)
+        self.assertEqual(sql.version, version)
+
+        where = sql._where
+        where += SQLWhere('d < 2')
+        self.assertTrue(sql.version > version)
+        self.assertEqual(sql.as_string, 'SELECT a FROM b WHERE c > 1 and d < 2 LIMIT 5')
+
+        version = sql.version
+        sql._limit = SQLLimit(10)
+        self.assertTrue(sql.version > version)
+        self.assertEqual(sql.as_string, 'SELECT a FROM b WHERE c > 1 and d < 2 LIMIT 10')
+
+        lazy = SQL.from_string('SELECT a FROM b WHERE c > 1', lazy=True)
+        version = lazy.version
+        lazy._where
+        self.assertEqual(lazy.version, version)
+        frozen = sql.freeze()
+        self.assertTrue(frozen.as_string is frozen.as_string)
+        self.assertEqual((frozen + SQLWhere('e')).as_string, 'SELECT a FROM b WHERE c > 1 and d < 2 and e LIMIT 10')
+
+    def test__optimized_sql__add(self):
+        from spyql import OptimizedSQL, SQL, SQLFrom, SQLWhere, SQLHaving
+        sql = OptimizedSQL.from_string('SELECT a, count(*) FROM t x inner join u on x.id = u.id WHERE a = 1 and b between 1 and 2 GROUP BY a HAVING count(*) > 1')
+        sql += SQLWhere('B BETWEEN 1 AND 2 and c = 3 and a=1')
+        sql += SQLWhere('a = 1 or d = 4')
+        sql += SQLFrom('t AS x inner join u on x.id=u.id, v')
+        sql += SQL.from_string('SELECT b FROM v WHERE c = 3 HAVING count(*) > 1 and a > 5')
+        self.assertEqual(sql.as_string, 'SELECT a, count(*), b FROM t x inner join u on x.id = u.id, v WHERE a = 1 and b between 1 and 2 and c = 3 and (a = 1 or d = 4) GROUP BY a HAVING count(*) > 1 and a > 5')
+
+        combined = OptimizedSQL.combine(['SELECT a FROM t WHERE a = 1', SQLWhere("a = 1 and e = 'x  y'"), SQLFrom('T')])
+        self.assertEqual(combined.as_string, "SELECT a FROM t WHERE a = 1 and e = 'x  y'")
+        self.assertEqual(SQL.combine(['SELECT a FROM t WHERE a = 1', SQLWhere('a = 1')]).as_string, 'SELECT a FROM t WHERE a = 1 and a = 1')
+        self.assertEqual((OptimizedSQL.from_string('SELECT a FROM t WHERE a or b') + SQLWhere('c')).as_string, 'SELECT a FROM t WHERE (a or b) and c')
+
+        sql.push_down_having()
+        self.assertEqual(sql._where.value, 'a = 1 and b between 1 and 2 and c = 3 and (a = 1 or d = 4) and a > 5')
+        self.assertEqual(sql._having.value, 'count(*) > 1')
+        OptimizedSQL.pushdown_having = True
+        try:
+            pushed = OptimizedSQL.from_string('SELECT a FROM t GROUP BY a, t.b') + SQLHaving('t.b > 1 and max(c) > 2 and total > 3')
+            self.assertEqual(pushed.as_string, 'SELECT a FROM t WHERE t.b > 1 GROUP BY a, t.b HAVING max(c) > 2 and total > 3')
+        finally:
+            OptimizedSQL.pushdown_having = False
+
+    def test__sql__tree(self):
+        from spyql import SQL, SQLVariants, SQLWhere
+        statements = ['select a.*, b.z as zz, count(*) total from apples a inner join bananas b using (c,d) where length(a.y) != length(b.z) and k in (select k from ytab where k > 5) group by a.y having count(a.y)<5 order by b.z limit 15',
+                      'SELECT "Odd Col", \'it\'\'s (\' FROM (select x from t) sub WHERE (a or b) and c between 1 and 2',
+                      'SELECT a FROM b WHERE f(g(h(1, (2))))']
+        for statement in statements:
+            sql = SQL.from_string(statement)
+            self.assertEqual(sql.tree().as_string, sql.as_string)
+
+        sql = SQL.from_string(statements[0])
+        tree = sql.tree()
+        self.assertTrue(sql.tree() is tree)
+        self.assertEqual(tree.tables, {'apples': set(['FROM']), 'bananas': set(['FROM']), 'ytab': set(['WHERE'])})
+        self.assertEqual(tree.aliases, {'a': 'apples', 'b': 'bananas', 'zz': 'b.z', 'total': 'count(*)'})
+        self.assertEqual(tree.get_clauses('A.Y'), set(['WHERE', 'GROUP BY', 'HAVING']))
+        self.assertEqual(tree.get_clauses('bananas.z'), set(['SELECT', 'WHERE', 'ORDER BY']))
+        self.assertEqual(tree.get_clauses('c'), set(['FROM']))
+        self.assertTrue(tree.is_filtered('k') and tree.is_filtered('apples.y'))
+        self.assertFalse(tree.is_filtered('zz') or tree.references_table('zz'))
+        self.assertEqual([node.kind for node in tree.clauses['ORDER BY'][1]], ['space', 'name'])
+
+        sql += SQLWhere('q = 1')
+        self.assertFalse(sql.tree() is tree)
+        self.assertTrue(sql.tree().is_filtered('q'))
+
+        # Subqueries may have a LIMIT that is not a number, e.g. a template placeholder.
+        for limit in (':n', 'all'):
+            sql = SQL.from_string('select a from t where b in (select c from u where d = 1 limit %s)' % limit)
+            self.assertEqual(sql.tree().as_string, sql.as_string)
+            self.assertEqual(sql.tree().get_clauses('d'), set(['WHERE']))
+            self.assertEqual(SQLVariants(sql, tables=['u']).render(tables={'u': 'u_1'}),
+                             'SELECT a FROM t WHERE b in (select c from u_1 where d = 1 limit %s)' % limit)
+
+    def test__sql_variants(self):
+        from spyql import SQL, SQLVariants, SQLWhere
+        base = 'select o.id, orders.total from orders o inner join items using (id) where o.day > 1 and o.id in (select id from orders) order by o.id limit 5'
+        variants = SQLVariants(base)
+        self.assertEqual(variants.render(), SQL.from_string(base).as_string)
+        for shard in range(3):
+            sql = SQL.from_string(base.replace('orders', 'orders_%d' % shard).replace('items', 'items_%d' % shard))
+            sql += SQLWhere('shard = %d' % shard)
+            self.assertEqual(variants.render(tables={'orders': 'orders_%d' % shard, 'items': 'items_%d' % shard}, where='shard = %d' % shard), sql.as_string)
+        self.assertEqual(variants.render(limit=1), SQL.from_string(base.replace('limit 5', 'limit 1')).as_string)
+
+        variants = SQLVariants(SQL.from_string('select a from t where a = 1 or b = 2 group by a'), tables=['t'])
+        self.assertEqual(variants.render(tables={'t': 't_1'}, where=SQLWhere('day = 1')), 'SELECT a FROM t_1 WHERE (a = 1 or b = 2) and day = 1 GROUP BY a')
+        substitutions = [{'tables': {'t': 't_%d' % shard}, 'limit': 10} for shard in range(2)]
+        self.assertEqual(list(variants.iter_render(substitutions[:1])), ['SELECT a FROM t_0 WHERE a = 1 or b = 2 GROUP BY a LIMIT 10'])
+        self.assertEqual(variants.union_all(substitutions), '(SELECT a FROM t_0 WHERE a = 1 or b = 2 GROUP BY a LIMIT 10) UNION ALL (SELECT a FROM t_1 WHERE a = 1 or b = 2 GROUP BY a LIMIT 10)')
+        self.assertEqual(SQLVariants('select a from t').union_all([{'where': 'p = 1'}, {'where': 'p = 2'}]), 'SELECT a FROM t WHERE p = 1 UNION ALL SELECT a FROM t WHERE p = 2')
+
+    def test__sql__pickle(self):
+        import pickle
+        from spyql import SQL, SQLWhere
+        sql = SQL.from_string('SELECT a FROM b WHERE c > 1 LIMIT 5') + SQLWhere('d < 2')
+        for query in (sql, sql.freeze()):
+            for protocol in range(pickle.HIGHEST_PROTOCOL + 1):
+                unpickled = pickle.loads(pickle.dumps(query, protocol))
+                self.assertEqual(type(unpickled), type(query))
+                self.assertEqual(unpickled.as_string, 'SELECT a FROM b WHERE c > 1 and d < 2 LIMIT 5')
+        self.assertEqual(pickle.loads(pickle.dumps(sql._limit)).value, 5)
+
+    def test__sql__to_bytes(self):
+        from spyql import SQL, FrozenSQL, OptimizedSQL, SQLComponent, SQLWhere, FrozenSQLLimit
+        statement = 'select a,\n\tb from t where x in (1, 2,\n 3) order by "c" limit 4'
+        expected = 'SELECT a,  b FROM t WHERE x in (1, 2,  3) ORDER BY "c" LIMIT 4'
+        composed = SQL.from_string('SELECT a FROM b') + SQLWhere("c = 'x\ny'")
+        queries = [SQL.from_string(statement), SQL.from_string(statement, lazy=True), FrozenSQL.from_string(statement),
+                   OptimizedSQL.from_string(statement), composed]
+        for query in queries:
+            data = query.to_bytes()
+            loaded = SQL.from_bytes(data)
+            self.assertEqual(type(loaded), type(query))
+            self.assertEqual(loaded.as_string, query.as_string)
+            self.assertEqual(SQL.from_bytes(bytearray(data)).as_string, query.as_string)
+        self.assertEqual(SQL.from_bytes(SQL.from_string(statement, lazy=True).to_bytes()).as_string, expected)
+        loaded = SQL.from_bytes(SQL.from_string(statement).to_bytes())
+        self.assertEqual(loaded._components[2].__class__, tuple)
+        loaded += SQLWhere('d = 1')
+        self.assertEqual(loaded.as_string, 'SELECT a,  b FROM t WHERE x in (1, 2,  3) and d = 1 ORDER BY "c" LIMIT 4')
+
+        limit = SQLComponent.from_bytes(FrozenSQLLimit(7).to_bytes())
+        self.assertEqual((type(limit), limit.value), (FrozenSQLLimit, 7))
+        self.assertRaises(ValueError, SQL.from_bytes, b'SPYQ')
+        self.assertRaises(ValueError, SQL.from_bytes, b'XXXX' + data[4:])
+        self.assertRaises(ValueError, SQL.from_bytes, data[:4] + b'\x63' + data[5:])
+        self.assertRaises(ValueError, SQL.from_bytes, limit.to_bytes())
+        # A clause whose offsets point past the body (here WHERE, the third entry) is rejected.
+        entry = 10 + 9 * 2
+        corrupted = data[:entry + 5] + b'\xff\xff\xff\xff' + data[entry + 9:]
+        self.assertRaises(ValueError, SQL.from_bytes, corrupted)
+        self.assertRaises(ValueError, SQL.from_bytes, data[:entry] + b'\x09' + data[entry + 1:])
+
+    def test__sql__disk_cache(self):
+        import os
+        import shutil
+        import tempfile
+        from spyql import SQL, FrozenSQL, SQLDiskCache
+        directory = tempfile.mkdtemp()
+        cache = SQLDiskCache(os.path.join(directory, 'cache'), max_bytes=200)
+        SQL.parse_cache = cache
+        try:
+            self.assertEqual(SQL.from_string('select a from b where c = 1').as_string, 'SELECT a FROM b WHERE c = 1')
+            self.assertEqual(SQL.from_string('select a from b where c = 1').as_string, 'SELECT a FROM b WHERE c = 1')
+            self.assertEqual((cache.hits, cache.misses, len(cache)), (1, 1, 1))
+            self.assertEqual(type(FrozenSQL.from_string('select a from b where c = 1')), FrozenSQL)
+            self.assertEqual((cache.hits, cache.misses, len(cache)), (1, 2, 2))
+
+            # Another process would see the same entries.
+            other = SQLDiskCache(cache.directory, max_bytes=200)
+            self.assertEqual(other.get((SQL, 'select a from b where c = 1', False)).as_string, 'SELECT a FROM b WHERE c = 1')
+
+            for n in range(10):
+                SQL.from_string('select a%d from b where c = %d' % (n, n))
+            self.assertTrue(cache.evictions > 0)
+            self.assertTrue(sum(os.path.getsize(path) for path in cache.iter_paths()) <= cache.max_bytes)
+            self.assertEqual(SQL.from_string('select a9 from b where c = 9').as_string, 'SELECT a9 FROM b WHERE c = 9')
+
+            with open(cache.get_path(SQL, 'select a9 from b where c = 9'), 'wb') as fileobj:
+                fileobj.write(b'garbage')
+            self.assertEqual(SQL.from_string('select a9 from b where c = 9').as_string, 'SELECT a9 FROM b WHERE c = 9')
+            cache.clear()
+            self.assertEqual(len(cache), 0)
+
+            # Puts only scan the directory when the cache may be over budget; scans drop stale temporary files.
+            cache = SQLDiskCache(os.path.join(directory, 'large'))
+            stale = os.path.join(cache.directory, 'crashed.tmp')
+            open(stale, 'w').close()
+            os.utime(stale, (0, 0))
+            scans = []
+            evict = cache.evict
+            cache.evict = lambda: scans.append(evict())
+            for n in range(10):
+                cache.put((SQL, 'select a from b where c = %d' % n, False), SQL.from_string('select a from b where c = %d' % n), 0)
+            self.assertEqual((len(scans), len(cache)), (1, 10))
+            self.assertFalse(os.path.exists(stale))
+
+            # Small hits do not keep a file descriptor open, so more of them than RLIMIT_NOFILE can stay alive.
+            try:
+                import resource
+            except ImportError:
+                return
+            soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+            resource.setrlimit(resource.RLIMIT_NOFILE, (128, hard))
+            try:
+                SQL.parse_cache = SQLDiskCache(os.path.join(directory, 'many'))
+                statements = ['select a from b where c = %d' % n for n in range(200)]
+                for statement in statements:
+                    SQL.from_string(statement)
+                hits = [SQL.from_string(statement) for statement in statements]
+                self.assertEqual(SQL.parse_cache.hits, 200)
+                self.assertEqual(hits[-1].as_string, 'SELECT a FROM b WHERE c = 199')
+            finally:
+                resource.setrlimit(resource.RLIMIT_NOFILE, (soft, hard))
+        finally:
+            SQL.parse_cache = None
+            shutil.rmtree(directory)
+
+    def test__parse_many(self):
+        from spyql import parse_many
+        statements = ['select c%d from t%d where c%d > %d' % (i, i, i, i) for i in range(50)]
+        expected = ['SELECT c%d FROM t%d WHERE c%d > %d' % (i, i, i, i) for i in range(50)]
+        self.assertEqual([sql.as_string for sql in parse_many(statements, workers=2, chunksize=4)], expected)
+        self.assertEqual([sql.as_string for sql in parse_many(iter(statements), workers=1, lazy=True)], expected)
+        parsed = parse_many(statements, workers=2, chunksize=4, lazy=True)
+        self.assertEqual(next(parsed).as_string, expected[0])
+        self.assertEqual([sql.as_string for sql in parsed], expected[1:])
+
+    def test__instrumentation(self):
+        from spyql import SQL, OptimizedSQL, OptimizedSQLWhere, SQLWhere, instrumentation
+        original_from_string = SQL.__dict__['from_string']
+        original_optimized_add_instance = OptimizedSQLWhere.__dict__['_add_instance']
+        events = []
+        callback = lambda name, seconds, size: events.append((name, size))
+        instrumentation.add_callback(callback)
+        instrumentation.reset()
+        instrumentation.enable()
+        try:
+            sql = SQL.from_string('SELECT a FROM b')
+            sql += SQLWhere('a > 1')
+            self.assertEqual(str(sql), 'SELECT a FROM b WHERE a > 1')
+        finally:
+            instrumentation.disable()
+            instrumentation.remove_callback(callback)
+        self.assertEqual(events[:3], [('tokenize_sql_offsets', 15), ('tokenize_sql_component', 15), ('SQL.from_string', 15)])
+        self.assertEqual(instrumentation.counts['SQLWhere._add_instance'], 1)
+        self.assertEqual(instrumentation.counts['SQL.as_string'], 1)
+        self.assertEqual(instrumentation.size_histograms['SQL.from_string'], {16: 1})
+        self.assertTrue(instrumentation.seconds['SQL.from_string'] >= instrumentation.seconds['tokenize_sql_component'])
+        self.assertFalse(instrumentation.enabled)
+        self.assertTrue(SQL.__dict__['from_string'] is original_from_string)
+
+        instrumentation.reset()
+        with instrumentation.profile() as profile:
+            SQL.from_string('select c from d').as_string
+        self.assertEqual(profile.totals()['SQL.from_string'][0], 1)
+        self.assertEqual([name for name, _, _ in profile.calls].count('SQLComponent.as_string'), 2)
+        SQL.from_string('select e from f')
+        self.assertEqual(len(profile.calls), 6)
+        self.assertEqual(instrumentation.counts['SQL.from_string'], 1)
+
+        with instrumentation.profile() as profile:
+            sql = SQL.from_buffer(b'select g from h')
+            self.assertEqual(sql._from.value, 'h')
+        self.assertEqual([(name, size) for name, _, size in profile.calls], [('tokenize_sql_offsets', 15), ('materialize_component', 1)])
+
+        with instrumentation.profile() as profile:
+            sql = OptimizedSQL('a', 'b', 'c > 1') + OptimizedSQL('a', 'b', 'c > 1 and d')
+        self.assertEqual(profile.totals()['OptimizedSQLWhere._add_instance'][0], 1)
+        self.assertEqual(profile.totals()['OptimizedSQLFrom._add_instance'][0], 1)
+        self.assertTrue(OptimizedSQLWhere.__dict__['_add_instance'] is original_optimized_add_instance)
+
+    def test__iter_statements(self):
+        try:
+            from StringIO import StringIO
+        except ImportError:
+            from io import StringIO
+        from spyql import iter_statements, set_backslash_escapes, split_statements
+        text = "-- don't; split\nSELECT a FROM b WHERE c = 'x;y' and d = 'C:\\' and e = 'it''s;';\n/* ; */ select e from (select f from g;) h;;\nselect 1 - 2 / 3 from z -- end\n"
+        expected = ["SELECT a FROM b WHERE c = 'x;y' and d = 'C:\\' and e = 'it''s;'", 'select e from (select f from g;) h', 'select 1 - 2 / 3 from z']
+        self.assertEqual(list(iter_statements(StringIO(text))), expected)
+        for chunk_size in range(1, 8):
+            chunks = (text[i:i + chunk_size] for i in range(0, len(text), chunk_size))
+            self.assertEqual([statement.strip() for statement in split_statements(chunks) if statement.strip()], expected)
+
+        set_backslash_escapes(True)
+        try:
+            text = "SELECT a FROM b WHERE d = \"q\\\";\";\nselect e from f\n"
+            expected = ['SELECT a FROM b WHERE d = "q\\";"', 'select e from f']
+            for chunk_size in range(1, 8):
+                chunks = (text[i:i + chunk_size] for i in range(0, len(text), chunk_size))
+                self.assertEqual([statement.strip() for statement in split_statements(chunks) if statement.strip()], expected)
+        finally:
+            set_backslash_escapes(False)
+
+    def test__iter_parse(self):
+        import os
+        import tempfile
+        from spyql import iter_parse
+        handle, path = tempfile.mkstemp(suffix='.sql')
+        try:
+            with os.fdopen(handle, 'wb') as sql_file:
+                sql_file.write(u'select a from b;\nCREATE TABLE c (d int);\nselect e from f limit 2;\n'.encode('utf-8') * 100)
+                sql_file.write(u"select '\u00e9\u00e9\u00e9' from g;\n".encode('utf-8'))
+            parsed = iter_parse(path, chunk_size=16, use_mmap=True, skip_invalid=True)
+            self.assertEqual(next(parsed).as_string, 'SELECT a FROM b')
+            self.assertEqual(next(parsed).as_string, 'SELECT e FROM f LIMIT 2')
+            parsed = list(parsed)
+            self.assertEqual(len(parsed), 199)
+            # Chunks of 16 bytes split the two-byte characters of the last statement.
+            expected = u"SELECT '\u00e9\u00e9\u00e9' FROM g"
+            self.assertEqual(parsed[-1].as_string, expected.encode('utf-8') if bytes is str else expected)
+            with self.assertRaises(ValueError):
+                list(iter_parse(path))
+        finally:
+            os.remove(path)
+
     def test__str_method_returns_query(self):
         from spyql import SQL, SQLSelect, SQLFrom, SQLWhere, SQLGroupBy, SQLHaving, SQLOrderBy, SQLLimit
 
@@ -0,0 +1,73 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+def collect(loop, generator):
+    items = []
+    while True:
+        try:
+            items.append(loop.run_until_complete(generator.__anext__()))
+        except StopAsyncIteration:
+            return items
+
+@unittest.skipIf(sys.version_info < (3, 7), 'spyql_async needs Python 3.7+')
+class TestAsync(unittest.TestCase):
+    maxDiff = None
+
+    def setUp(self):
+        import asyncio
+        from spyql_executor import Executor, sqlite_pool
+        self.loop = asyncio.new_event_loop()
+        self.directory = tempfile.mkdtemp()
+        self.pool = sqlite_pool(os.path.join(self.directory, 'test.db'), max_connections=2, timeout=5)
+        self.executor = Executor(self.pool, batch_size=2)
+        self.executor.run('CREATE TABLE numbers (n INTEGER)')
+        self.executor.run_many('INSERT INTO numbers VALUES (?)', [(n,) for n in range(10)])
+
+    def tearDown(self):
+        self.loop.close()
+        self.pool.close()
+        shutil.rmtree(self.directory)
+
+    def test__aparse(self):
+        from spyql import SQL
+        from spyql_async import aparse
+        statement = 'SELECT a FROM b WHERE ' + ' and '.join('c%d = %d' % (n, n) for n in range(100))
+        for threshold in (None, 0):
+            sql = self.loop.run_until_complete(aparse(statement, threshold=threshold))
+            self.assertEqual(sql.as_string, SQL.from_string(statement).as_string)
+        sql = self.loop.run_until_complete(aparse(statement, lazy=True, threshold=0))
+        self.assertEqual(sql._components[0], (7, 8))
+
+    def test__async_executor(self):
+        from spyql import SQL, SQLTemplate
+        from spyql_async import AsyncExecutor
+        executor = AsyncExecutor(self.executor, concurrency=2)
+        sql = SQL.from_string('SELECT n FROM numbers WHERE n < 5 ORDER BY n')
+        self.assertEqual(self.loop.run_until_complete(executor.fetch_all(sql)), [(n,) for n in range(5)])
+        self.assertEqual(collect(self.loop, executor.iter_batches(sql)), [[(0,), (1,)], [(2,), (3,)], [(4,)]])
+        self.assertEqual(self.loop.run_until_complete(executor.run('DELETE FROM numbers WHERE n >= ?', (8,))), 2)
+
+        template = SQLTemplate('SELECT count(*) FROM numbers WHERE n < :n')
+        queries = ((template, {'n': n}) for n in range(8))
+        self.assertEqual(collect(self.loop, executor.map(queries, max_pending=3)), [[(n,)] for n in range(8)])
+
+    def test__async_executor__backpressure(self):
+        from spyql_async import AsyncExecutor
+        executor = AsyncExecutor(self.executor, concurrency=1)
+        pulled = []
+        def queries():
+            for n in range(100):
+                pulled.append(n)
+                yield 'SELECT %d' % n
+        results = executor.map(queries(), max_pending=2)
+        self.assertEqual(self.loop.run_until_complete(results.__anext__()), [(0,)])
+        self.assertEqual(pulled, [0, 1])
+        self.loop.run_until_complete(results.aclose())
+        self.assertEqual(executor.semaphore._value, 1)
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
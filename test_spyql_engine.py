@@ -0,0 +1,91 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+FRUIT = [
+    {'name': 'apple', 'color': 'red', 'weight': 3},
+    {'name': 'banana', 'color': 'yellow', 'weight': 2},
+    {'name': 'cherry', 'color': 'red', 'weight': 1},
+    {'name': 'kiwi', 'color': 'green', 'weight': None},
+    {'name': 'lemon', 'color': 'yellow', 'weight': 4},
+]
+
+class TestEngine(unittest.TestCase):
+    maxDiff = None
+
+    def test__engine__filter_and_project(self):
+        from spyql import SQL, SQLWhere
+        from spyql_engine import compile_plan, execute, iter_record_batches
+        sql = SQL.from_string("SELECT name, weight * 10 AS grams FROM fruit WHERE color = 'red' or weight > 3")
+        plan = compile_plan(sql)
+        self.assertEqual(plan.columns, ['name', 'grams'])
+        self.assertEqual(list(plan.execute(iter_record_batches(FRUIT, batch_size=2))), [('apple', 30), ('cherry', 10), ('lemon', 40)])
+
+        self.assertEqual(execute(sql + SQLWhere("name LIKE '%e%'"), iter_record_batches(FRUIT)), [('apple', 30), ('cherry', 10), ('lemon', 40)])
+        self.assertEqual(execute("SELECT name FROM fruit WHERE not weight > 1", iter_record_batches(FRUIT)), [('cherry',)])
+        self.assertEqual(execute("SELECT name FROM fruit WHERE weight IS NULL or color NOT IN ('red', 'yellow')", iter_record_batches(FRUIT)), [('kiwi',)])
+        self.assertEqual(execute("SELECT upper(name), coalesce(weight, 0) FROM fruit WHERE weight BETWEEN 2 AND 3 or weight is null", iter_record_batches(FRUIT)),
+                         [('APPLE', 3), ('BANANA', 2), ('KIWI', 0)])
+        plan = compile_plan('SELECT * FROM fruit LIMIT 1')
+        rows = list(plan.execute(iter_record_batches(FRUIT)))
+        self.assertEqual([dict(zip(plan.columns, row)) for row in rows], FRUIT[:1])
+        self.assertEqual(execute('SELECT a % 2, a / 2, a % -2 FROM t', iter_record_batches([{'a': -7}, {'a': 7}, {'a': -7.5}])),
+                         [(-1, -3, -1), (1, 3, 1), (-1.5, -3.75, -1.5)])
+        self.assertRaises(ValueError, compile_plan, 'SELECT name FROM fruit WHERE weight >')
+        self.assertRaises(ValueError, execute, 'SELECT size FROM fruit', iter_record_batches(FRUIT))
+
+    def test__engine__aggregate(self):
+        from spyql_engine import compile_plan, execute, iter_record_batches
+        sql = 'SELECT color, count(*) AS n, sum(weight), avg(weight), max(name) FROM fruit GROUP BY color HAVING count(*) > 1'
+        self.assertEqual(execute(sql, iter_record_batches(FRUIT, batch_size=2)),
+                         [('red', 2, 4, 2.0, 'cherry'), ('yellow', 2, 6, 3.0, 'lemon')])
+        self.assertEqual(execute('SELECT count(weight), count(DISTINCT color), min(weight) FROM fruit', iter_record_batches(FRUIT)), [(4, 3, 1)])
+        self.assertEqual(execute('SELECT count(*), sum(weight) FROM fruit', iter_record_batches([])), [(0, None)])
+        self.assertEqual(execute('SELECT upper(color), count(*) FROM fruit GROUP BY upper(color) ORDER BY 2 DESC, 1', iter_record_batches(FRUIT)),
+                         [('RED', 2), ('YELLOW', 2), ('GREEN', 1)])
+        self.assertRaises(ValueError, compile_plan, 'SELECT name, count(*) FROM fruit GROUP BY color')
+        self.assertEqual(execute('SELECT color, count(*) AS n FROM fruit GROUP BY color ORDER BY n DESC, color LIMIT 2', iter_record_batches(FRUIT)),
+                         [('red', 2), ('yellow', 2)])
+        self.assertRaises(ValueError, compile_plan, 'SELECT color, count(*) FROM fruit GROUP BY color ORDER BY 3')
+
+    def test__engine__order_and_limit(self):
+        from spyql_engine import execute, iter_record_batches
+        sql = 'SELECT name FROM fruit ORDER BY weight DESC, name'
+        self.assertEqual(execute(sql, iter_record_batches(FRUIT, batch_size=2)), [('lemon',), ('apple',), ('banana',), ('cherry',), ('kiwi',)])
+        self.assertEqual(execute(sql + ' LIMIT 2', iter_record_batches(FRUIT, batch_size=2)), [('lemon',), ('apple',)])
+        self.assertEqual(execute('SELECT name, weight FROM fruit ORDER BY weight LIMIT 2', iter_record_batches(FRUIT)), [('kiwi', None), ('cherry', 1)])
+        self.assertEqual(execute('SELECT name, weight * 10 AS grams FROM fruit ORDER BY grams DESC LIMIT 2', iter_record_batches(FRUIT)),
+                         [('lemon', 40), ('apple', 30)])
+        self.assertEqual(execute('SELECT name AS weight FROM fruit ORDER BY weight', iter_record_batches(FRUIT)),
+                         [('apple',), ('banana',), ('cherry',), ('kiwi',), ('lemon',)])
+        self.assertTrue('lemon' in execute('SELECT * FROM fruit ORDER BY weight DESC LIMIT 1', iter_record_batches(FRUIT))[0])
+        self.assertEqual(execute('SELECT DISTINCT color FROM fruit ORDER BY color', iter_record_batches(FRUIT, batch_size=2)),
+                         [('green',), ('red',), ('yellow',)])
+        self.assertEqual(execute('SELECT DISTINCT color FROM fruit LIMIT 2', iter_record_batches(FRUIT)), [('red',), ('yellow',)])
+
+        pulled = []
+        def records():
+            for n in range(1000):
+                pulled.append(n)
+                yield {'n': n}
+        self.assertEqual(execute('SELECT n FROM numbers WHERE n % 2 = 1 LIMIT 3', iter_record_batches(records(), batch_size=4)), [(1,), (3,), (5,)])
+        self.assertEqual(len(pulled), 8)
+
+    def test__engine__csv(self):
+        from spyql_engine import execute, iter_csv_batches
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'fruit.csv')
+            with open(path, 'w') as fileobj:
+                fileobj.write('name,color,weight\n')
+                fileobj.writelines('%s,%s,%s\n' % (row['name'], row['color'], '' if row['weight'] is None else row['weight']) for row in FRUIT)
+            self.assertEqual([len(batch['name']) for batch in iter_csv_batches(path, batch_size=2)], [2, 2, 1])
+            self.assertEqual(execute('SELECT color, sum(weight) FROM fruit GROUP BY color ORDER BY color', iter_csv_batches(path, batch_size=2)),
+                             [('green', None), ('red', 4), ('yellow', 6)])
+        finally:
+            shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
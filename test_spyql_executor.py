@@ -0,0 +1,96 @@
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+class TestExecutor(unittest.TestCase):
+    maxDiff = None
+
+    def setUp(self):
+        from spyql_executor import sqlite_pool
+        self.directory = tempfile.mkdtemp()
+        self.pool = sqlite_pool(os.path.join(self.directory, 'test.db'), max_connections=2, timeout=1)
+        with self.pool.connection() as connection:
+            connection.execute('CREATE TABLE fruit (name TEXT, color TEXT, weight INTEGER)')
+            connection.commit()
+
+    def tearDown(self):
+        self.pool.close()
+        shutil.rmtree(self.directory)
+
+    def test__normalize_statement(self):
+        from spyql_executor import normalize_statement
+        self.assertEqual(normalize_statement("SELECT  a,\n\tb FROM t WHERE c = 'x  \n y' ;"), "SELECT a, b FROM t WHERE c = 'x  \n y'")
+        self.assertEqual(normalize_statement('SELECT "a  b" FROM t'), 'SELECT "a  b" FROM t')
+
+    def test__executor__run_and_stream(self):
+        from spyql import SQL, SQLTemplate, SQLWhere
+        from spyql_executor import Executor
+        executor = Executor(self.pool, batch_size=2)
+        rows = [{'name': 'apple', 'color': 'red', 'weight': 3},
+                {'name': 'banana', 'color': 'yellow', 'weight': 2},
+                {'name': 'cherry', 'color': 'red', 'weight': 1}]
+        self.assertEqual(executor.run_many('INSERT INTO fruit VALUES (?, ?, ?)', [(row['name'], row['color'], row['weight']) for row in rows]), 3)
+
+        sql = SQL.from_string('SELECT name FROM fruit ORDER BY weight')
+        self.assertEqual([len(batch) for batch in executor.iter_batches(sql)], [2, 1])
+        self.assertEqual(list(executor.execute(sql)), [('cherry',), ('banana',), ('apple',)])
+
+        template = SQLTemplate(sql + SQLWhere('color = :color'))
+        self.assertEqual(list(executor.execute(template, {'color': 'red'})), [('cherry',), ('apple',)])
+        self.assertEqual(executor.run('DELETE FROM fruit WHERE color = ?', ('yellow',)), 1)
+        self.assertEqual(list(executor.execute('SELECT  count(*)\nFROM fruit;')), [(2,)])
+        # The statement runs as written: collapsing its newlines would extend the line comment.
+        self.assertEqual(list(executor.execute('select 1 -- one\n, 2')), [(1, 2)])
+
+    def test__executor__statement_cache(self):
+        from spyql_executor import Executor
+        executor = Executor(self.pool)
+        for _ in range(3):
+            list(executor.execute('SELECT * FROM fruit'))
+            list(executor.execute('SELECT  *\nFROM fruit;'))
+        with self.pool.connection() as connection:
+            self.assertEqual((connection.statements.hits, connection.statements.misses), (5, 2))
+            self.assertEqual(len(connection.statements), 2) # with the CREATE TABLE from setUp
+            connection.statements.max_statements = 1
+            connection.execute('SELECT 1')
+            connection.execute('SELECT 2')
+            self.assertEqual((len(connection.statements), connection.statements.evictions), (1, 3))
+
+    def test__connection_pool__bounded(self):
+        first = self.pool.acquire()
+        second = self.pool.acquire()
+        self.assertEqual(self.pool.size, 2)
+        self.assertRaises(ValueError, self.pool.acquire, 0.01)
+
+        acquired = []
+        thread = threading.Thread(target=lambda: acquired.append(self.pool.acquire()))
+        thread.start()
+        self.pool.release(first)
+        thread.join()
+        self.assertTrue(acquired[0] is first)
+        self.pool.release(second)
+        self.pool.release(acquired[0])
+        self.assertEqual(self.pool.size, 2)
+
+    def test__connection_pool__rollback(self):
+        from spyql_executor import Executor
+        try:
+            with self.pool.connection() as connection:
+                connection.execute("INSERT INTO fruit VALUES ('kiwi', 'green', 1)")
+                raise KeyError('kiwi')
+        except KeyError:
+            pass
+        self.assertEqual(list(Executor(self.pool).execute('SELECT count(*) FROM fruit')), [(0,)])
+
+        stream = Executor(self.pool).iter_batches('SELECT count(*) FROM fruit')
+        next(stream)
+        stream.close()
+        self.assertEqual(len(self.pool._idle), self.pool.size)
+        with self.pool.connection() as connection:
+            self.assertFalse('SELECT count(*) FROM fruit' in connection.statements._cursors)
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)